@@ -0,0 +1,109 @@
+from enum import IntEnum
+import pygame
+
+
+class Action(IntEnum):
+    Left = 1
+    Right = 2
+    Up = 3
+    Down = 4
+    Flip = 5
+    Grind = 6
+    Ollie = 7
+
+
+directions = (Action.Left, Action.Right, Action.Up, Action.Down)
+
+default_bindings = {
+    pygame.K_LEFT: Action.Left,
+    pygame.K_RIGHT: Action.Right,
+    pygame.K_UP: Action.Up,
+    pygame.K_DOWN: Action.Down,
+    pygame.K_x: Action.Flip,
+    pygame.K_c: Action.Grind,
+    pygame.K_SPACE: Action.Ollie,
+}
+
+
+class ActionMap(object):
+    """
+    Which action each key performs. Events are looked up by keycode, so handling one is a single dict lookup,
+    and the reverse table answers whether an action is held. Any number of keys may share an action.
+    """
+    def __init__(self, bindings=None):
+        self.actions = dict(default_bindings if bindings is None else bindings)
+        self._index()
+
+    def _index(self):
+        self.keys = {action: [] for action in Action}
+        for key, action in self.actions.items():
+            self.keys[action].append(key)
+
+    def get(self, key):
+        return self.actions.get(key)
+
+    def bind(self, key, action):
+        self.actions[key] = action
+        self._index()
+
+    def unbind(self, key):
+        self.actions.pop(key, None)
+        self._index()
+
+    def rebind(self, action, *keys):
+        # Replaces every key for the action
+        for key in self.keys[action]:
+            del self.actions[key]
+        for key in keys:
+            self.actions[key] = action
+        self._index()
+
+    def is_held(self, keys, action):
+        return any(keys.is_pressed(key) for key in self.keys[action])
+
+
+class InputBuffer(object):
+    """
+    The most recent actions and when they happened, in a fixed size ring.
+    Queries walk back from the newest, stopping at the start of their window.
+    """
+    def __init__(self, capacity=32):
+        self.capacity = capacity
+        self.times = [0] * capacity
+        self.actions = [None] * capacity
+        # Where the next action goes
+        self.head = 0
+
+    def clear(self):
+        self.actions = [None] * self.capacity
+        self.head = 0
+
+    def push(self, time, action):
+        self.times[self.head] = time
+        self.actions[self.head] = action
+        self.head = (self.head + 1) % self.capacity
+
+    def _slots(self):
+        # Newest first
+        for offset in range(1, self.capacity + 1):
+            yield (self.head - offset) % self.capacity
+
+    def find(self, actions, since):
+        # The newest of the given actions at or after the given time, or None
+        for slot in self._slots():
+            action = self.actions[slot]
+            if action is None or self.times[slot] < since:
+                return None
+            if action in actions:
+                return action
+        return None
+
+    def consume(self, action):
+        # Marks the newest of an action as dealt with, so no later query finds it
+        for slot in self._slots():
+            if self.actions[slot] is None:
+                return
+            if self.actions[slot] == action:
+                # Still walked past by queries, unlike an empty slot
+                self.actions[slot] = 0
+                return
@@ -0,0 +1,268 @@
+import os
+# Headless: no window, no frame cap
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import json
+import time
+import pygame
+from actions import ActionMap
+import environment
+import playback
+from preload import walk_chain
+import render
+from skater import Skater
+
+
+class Probe(object):
+    """
+    Just enough of main.State for a Skater to play one environment on its own.
+    Leaving the scene is recorded rather than acted on.
+    """
+    def __init__(self, env):
+        self.env = env
+        self.timer = playback.SimulationClock()
+        self.keys = playback.KeyState()
+        self.actions = ActionMap()
+        self.particles = None
+        self.world = pygame.sprite.LayeredDirty()
+        self.exit = None
+
+    def update_environment(self, next=True):
+        self.exit = 'next' if next else 'prev'
+
+    def update_combo(self, trick):
+        pass
+
+    def end_combo(self):
+        pass
+
+    def record(self, kind, trick=None, value=0):
+        pass
+
+
+class Sequence(object):
+    """
+    One way of playing a level: enter it at a speed, ollie some ticks after first touching down,
+    optionally ollie again every `repeat` ticks after that, and optionally press grind some ticks after each ollie.
+    """
+    __slots__ = ('speed', 'ollie', 'repeat', 'grind')
+
+    def __init__(self, speed, ollie, repeat, grind):
+        self.speed = speed
+        self.ollie = ollie
+        self.repeat = repeat
+        self.grind = grind
+
+    def get_keys(self, tick):
+        # The keys pressed this many ticks after first touching down
+        if self.ollie is None or tick < self.ollie:
+            return ()
+        since = tick - self.ollie
+        if self.repeat:
+            since %= self.repeat
+        if since == 0:
+            return pygame.K_SPACE,
+        if since == self.grind:
+            return pygame.K_c,
+        return ()
+
+
+def get_sequences(speeds, ollie_ticks, repeats, grinds):
+    return [Sequence(*args) for args in itertools.product(speeds, ollie_ticks, repeats, grinds)]
+
+
+def label_order(label):
+    kind, index = label.split()
+    return kind, int(index)
+
+
+def gap_order(item):
+    (start, end), _ = item
+    return label_order(start), label_order(end)
+
+
+def get_label(env, surface):
+    if surface in env.ledges:
+        return 'ledge %d' % env.ledges.index(surface)
+    return 'geo %d' % env.collision.index(surface)
+
+
+def reset(bob, state, speed):
+    # Put a reused skater back how Skater.__init__ leaves it, entering the scene as it would from the last one
+    bob.state = state
+    bob.velocity.update(speed, 0)
+    bob.position.update(0, 0)
+    bob.last_position.update(0, 0)
+    bob.rect.topleft = (0, 0)
+    bob.depart()
+    bob.inputs.clear()
+    bob.latent_action, bob.latent_action_deadline = None, -1
+    bob.current_ledge = None
+    bob.animate('float')
+    bob.anim_time, bob.frame = 0, 0
+
+
+def play(bob, env, sequence, dt, max_ticks):
+    """
+    Returns how the run ended, the surfaces it rode in order,
+    and a (from, to, speed) triple for every jump from one surface to another.
+    """
+    state = Probe(env)
+    reset(bob, state, sequence.speed)
+    labels = {surface: get_label(env, surface) for surface in env.geo}
+    path, gaps = [], []
+    takeoff, landed_tick = None, None
+    outcome = 'timeout'
+
+    for tick in range(max_ticks):
+        if landed_tick is not None:
+            for key in sequence.get_keys(tick - landed_tick):
+                for event_type in (pygame.KEYDOWN, pygame.KEYUP):
+                    event = pygame.event.Event(event_type, key=key, mod=0)
+                    state.keys.handle(event)
+                    bob.handle(event)
+
+        state.timer.advance(dt)
+        bob.update(dt)
+
+        if state.exit:
+            outcome = state.exit
+            break
+        # Dropping off the bottom puts the skater back at the origin without changing scene
+        if bob.position.x == 0 and bob.position.y == 0:
+            outcome = 'fell'
+            break
+        if bob.animation == 'falling':
+            outcome = 'hazard'
+            break
+
+        surface = labels.get(bob.surface)
+        if surface:
+            if landed_tick is None:
+                landed_tick = tick
+            if not path or path[-1] != surface:
+                path.append(surface)
+            if takeoff and takeoff[0] != surface:
+                gaps.append((takeoff[0], surface, takeoff[1]))
+            takeoff = None
+        elif path and takeoff is None:
+            takeoff = path[-1], abs(bob.velocity.x)
+
+    return outcome, path, gaps
+
+
+# Per worker process: the display, a skater and every environment it's been asked about, loaded once
+_worker = {}
+
+
+def _init_worker():
+    pygame.init()
+    pygame.display.set_mode((1, 1))
+    _worker['bob'] = Skater('assets/Skata.json', None)
+    _worker['envs'] = {}
+
+
+def _run_chunk(level, sequences, dt, max_ticks):
+    envs = _worker['envs']
+    if level not in envs:
+        # Probes skate at the design resolution, as a skater with no state does
+        envs[level] = environment.Environment(level, render.design_size)
+    return [play(_worker['bob'], envs[level], sequence, dt, max_ticks) for sequence in sequences]
+
+
+class LevelReport(object):
+    def __init__(self, level):
+        self.level = level
+        self.runs = 0
+        self.outcomes = {}
+        self.reachable = set()
+        # Surfaces ridden on the way to the next scene
+        self.leads_out = set()
+        # (from, to) -> [slowest takeoff which made it, runs which made it]
+        self.gaps = {}
+
+    def add(self, outcome, path, gaps):
+        self.runs += 1
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+        self.reachable.update(path)
+        if outcome == 'next':
+            self.leads_out.update(path)
+        for start, end, speed in gaps:
+            gap = self.gaps.setdefault((start, end), [speed, 0])
+            gap[0] = min(gap[0], speed)
+            gap[1] += 1
+
+    def get_dead_ends(self):
+        # Somewhere a run can get to, but never get on from
+        return self.reachable - self.leads_out
+
+    def to_dict(self):
+        return {
+            'level': self.level,
+            'runs': self.runs,
+            'outcomes': self.outcomes,
+            'reachable': sorted(self.reachable, key=label_order),
+            'dead_ends': sorted(self.get_dead_ends(), key=label_order),
+            'gaps': [{'from': start, 'to': end, 'min_speed': speed, 'runs': runs}
+                     for (start, end), (speed, runs) in sorted(self.gaps.items(), key=gap_order)],
+        }
+
+
+def analyze(levels, sequences, dt, max_ticks, workers=None, chunk_size=64):
+    reports = {level: LevelReport(level) for level in levels}
+    jobs = [(level, sequences[i:i + chunk_size]) for level in levels for i in range(0, len(sequences), chunk_size)]
+    with ProcessPoolExecutor(workers, initializer=_init_worker) as executor:
+        futures = [(level, executor.submit(_run_chunk, level, chunk, dt, max_ticks)) for level, chunk in jobs]
+        for level, future in futures:
+            for result in future.result():
+                reports[level].add(*result)
+    return [reports[level] for level in levels]
+
+
+def frange(start, stop, step):
+    return [round(start + i * step, 6) for i in range(int(round((stop - start) / step)) + 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Find which surfaces each level lets a skater reach, and how')
+    parser.add_argument('level', nargs='?', default='assets/Basic.json', help='Any level in the next / prev chain')
+    parser.add_argument('--workers', type=int, help='Processes to spread the runs across; defaults to every core')
+    parser.add_argument('--speeds', type=float, nargs=3, default=(0.1, 1.2, 0.1), metavar=('MIN', 'MAX', 'STEP'),
+                        help='Entry speeds in pixels per millisecond')
+    parser.add_argument('--ollie-step', type=int, default=8, help='Ticks between tried ollie timings')
+    parser.add_argument('--ollie-max', type=int, default=300, help='Latest tried ollie, in ticks after touching down')
+    parser.add_argument('--dt', type=float, default=1000 / 120, help='Simulated milliseconds per tick')
+    parser.add_argument('--max-ticks', type=int, default=1500, help='Give up on a run after this many ticks')
+    parser.add_argument('--output', help='Also write the report to this JSON file')
+    args = parser.parse_args()
+
+    sequences = get_sequences(frange(*args.speeds),
+                              [None] + list(range(0, args.ollie_max + 1, args.ollie_step)),
+                              (None, 90), (None, 15, 30))
+    levels = walk_chain(args.level)
+
+    start = time.perf_counter()
+    reports = analyze(levels, sequences, args.dt, args.max_ticks, args.workers)
+    seconds = time.perf_counter() - start
+
+    runs = sum(report.runs for report in reports)
+    print('%d runs over %d levels in %.2fs' % (runs, len(levels), seconds))
+    for report in reports:
+        print('%s: %s' % (report.level, ', '.join('%s %d' % item for item in sorted(report.outcomes.items()))))
+        print('  reachable: %s' % ', '.join(sorted(report.reachable, key=label_order)))
+        for (start, end), (speed, count) in sorted(report.gaps.items(), key=gap_order):
+            print('  %-9s -> %-9s needs %.2f px/ms (%d runs)' % (start, end, speed, count))
+        print('  dead ends: %s' % (', '.join(sorted(report.get_dead_ends(), key=label_order)) or 'none'))
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'seconds': seconds, 'levels': [report.to_dict() for report in reports]}, file, indent=2)
+        print('Wrote %s' % args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+import random
+import sys
+import timeit
+import pygame
+from environment import Surface, SurfaceType
+from spatial import SpatialGrid
+
+
+def make_level(count, width, height=720, seed=1):
+    rng = random.Random(seed)
+    return [Surface(rng.choice(list(SurfaceType)),
+                    rng.randrange(width), rng.randrange(height), rng.randrange(16, 400), rng.randrange(8, 120))
+            for _ in range(count)]
+
+
+def linear_first(rect, surfaces):
+    # What Environment.get_surface_at used to do
+    for idx in rect.collidelistall(surfaces):
+        return surfaces[idx]
+
+    return None
+
+
+def main(args):
+    # Usage: python bench_spatial.py [queries]
+    queries = int(args[0]) if args else 10000
+    rng = random.Random(2)
+
+    print('%8s %8s %12s %12s %8s' % ('rects', 'width', 'linear us', 'grid us', 'speedup'))
+    for count, width in ((10, 960), (100, 9600), (1000, 96000), (10000, 960000)):
+        surfaces = make_level(count, width)
+        grid = SpatialGrid(surfaces)
+        rects = [pygame.Rect(rng.randrange(width), rng.randrange(720), 128, 128) for _ in range(queries)]
+
+        linear = timeit.timeit(lambda: [linear_first(rect, surfaces) for rect in rects], number=1)
+        indexed = timeit.timeit(lambda: [grid.query_rect(rect) for rect in rects], number=1)
+        print('%8d %8d %12.2f %12.2f %7.1fx' % (count, width, linear / queries * 1e6, indexed / queries * 1e6,
+                                                linear / indexed))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,215 @@
+import os
+# Headless: no window, no frame cap
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import argparse
+import json
+import platform
+import sys
+import time
+import pygame
+import environment
+import main as game
+import playback
+from preload import walk_chain
+import render
+import skater
+import spritesheet
+
+
+# (tick, key) pairs, repeated every `period` ticks: push, push, push, ollie into a kickflip, then a grind
+default_script = (
+    (0, 'right'), (40, 'right'), (80, 'right'),
+    (120, 'space'), (122, 'x'), (123, 'left'),
+    (180, 'c'),
+)
+default_period = 240
+
+
+class Phase(object):
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.seconds = 0.0
+        self.blocks = 0
+
+    def report(self, overhead=None):
+        calls = max(self.calls, 1)
+        overhead = overhead or Phase('overhead')
+        overhead_calls = max(overhead.calls, 1)
+        return {
+            'calls': self.calls,
+            'total_ms': self.seconds * 1000,
+            'mean_us': (self.seconds / calls - overhead.seconds / overhead_calls) * 1e6,
+            # Blocks still allocated after a call less those before it: what a call keeps (e.g. a leak) shows up,
+            # but anything allocated and freed again within the call doesn't - it's not a count of allocations
+            'net_live_blocks_per_call': self.blocks / calls - overhead.blocks / overhead_calls,
+        }
+
+
+def measure_overhead(count=10000):
+    # What the instrumentation itself costs per call, subtracted from every phase
+    class Nothing(object):
+        def call(self):
+            pass
+
+    phases = {}
+    instrument(phases, Nothing, 'call', 'overhead')
+    nothing = Nothing()
+    for _ in range(count):
+        nothing.call()
+    return phases['overhead']
+
+
+def instrument(phases, owner, name, label):
+    # Wrap a method so every call is timed and counted against its phase
+    phase = phases[label] = Phase(label)
+    original = getattr(owner, name)
+    perf_counter = time.perf_counter
+    allocated_blocks = sys.getallocatedblocks
+
+    def wrapper(*args, **kwargs):
+        blocks = allocated_blocks()
+        start = perf_counter()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            phase.seconds += perf_counter() - start
+            phase.blocks += allocated_blocks() - blocks
+            phase.calls += 1
+
+    setattr(owner, name, wrapper)
+    return original
+
+
+def load_script(filename):
+    # A JSON list of [tick, key name] pairs, e.g. [[0, "right"], [120, "space"]], plus an optional period
+    with open(filename) as file:
+        script = json.load(file)
+    if isinstance(script, dict):
+        return [tuple(step) for step in script['steps']], script.get('period')
+    return [tuple(step) for step in script], None
+
+
+def scripted_frames(ticks, dt, script, period):
+    keys = [(tick, pygame.key.key_code(name)) for tick, name in script]
+    for tick in range(ticks):
+        local_tick = tick % period if period else tick
+        for when, key in keys:
+            if when == local_tick:
+                pygame.event.post(pygame.event.Event(pygame.KEYDOWN, key=key, mod=0))
+        yield dt
+
+
+def replayed_frames(state, recording):
+    # A recorded session as a fixture - the same inputs and dts, frame for frame
+    state.input = playback.ReplayInput(recording)
+    while state.input.next_frame():
+        yield state.input.dt
+
+
+def run(level, ticks, dt, script, period, recording=None, size=render.design_size):
+    if recording:
+        level = recording.level
+
+    pygame.init()
+    # Just the internal surface; stretching it to a window is the display's work, not ours
+    screen = render.set_mode(size, is_scaled=False)
+    state = game.State(pygame.time.Clock(), screen, level)
+    # Polling the level's files for changes would only add noise to the numbers
+    if state.reloader:
+        state.reloader.close()
+        state.reloader = None
+    # Runs of the benchmark aren't anyone's scores
+    if state.telemetry:
+        state.telemetry.close()
+        state.telemetry = None
+    # Warm the cache with the whole chain, so the numbers are about simulation rather than loading
+    for filename in walk_chain(level):
+        state.environments.get(filename)
+
+    overhead = measure_overhead()
+    phases = {}
+    originals = [
+        (skater.Skater, 'update', instrument(phases, skater.Skater, 'update', 'Skater.update')),
+        (environment.Environment, 'get_surface_at',
+         instrument(phases, environment.Environment, 'get_surface_at', 'Environment.get_surface_at')),
+        (spritesheet.SpriteSheet, 'update', instrument(phases, spritesheet.SpriteSheet, 'update', 'SpriteSheet.update')),
+        (game, 'simulate', instrument(phases, game, 'simulate', 'simulate')),
+        (state.renderer, 'draw', instrument(phases, state.renderer, 'draw', 'draw')),
+    ]
+
+    frames = replayed_frames(state, recording) if recording else scripted_frames(ticks, dt, script, period)
+    envs = set()
+    ticks = 0
+    start = time.perf_counter()
+    try:
+        for frame_dt in frames:
+            if not game.game_tick(state, frame_dt):
+                break
+            ticks += 1
+            envs.add(state.env.filename)
+    finally:
+        seconds = time.perf_counter() - start
+        for owner, name, original in originals:
+            setattr(owner, name, original)
+        state.close()
+        pygame.quit()
+
+    draw = phases['draw']
+    return {
+        'level': level,
+        'resolution': list(size),
+        'ticks': ticks,
+        'dt': None if recording else dt,
+        'replay': recording is not None,
+        'seconds': seconds,
+        'ticks_per_second': ticks / seconds,
+        'environments_visited': sorted(envs),
+        'phases': {name: phase.report(overhead) for name, phase in phases.items()},
+        'average_pixels_pushed': state.renderer.get_average_pixels_pushed(),
+        # Fill rate: how long a frame takes to draw, and how many pixels a second that works out to
+        'draw_ms_per_frame': draw.seconds * 1000 / max(draw.calls, 1),
+        'megapixels_per_second': state.renderer.total_pixels_pushed / draw.seconds / 1e6 if draw.seconds else 0,
+        'first_frame_ms': state.first_frame_time,
+        'preload_ms': state.preloader.get_elapsed(),
+        'python': platform.python_version(),
+        'pygame': pygame.version.ver,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless simulation benchmark')
+    parser.add_argument('level', nargs='?', default='assets/Basic.json')
+    parser.add_argument('--ticks', type=int, default=5000)
+    parser.add_argument('--dt', type=float, default=1000 / 60, help='Simulated milliseconds per tick')
+    parser.add_argument('--script', help='JSON list of [tick, key name] inputs')
+    parser.add_argument('--replay', help='Drive the run from a session recorded with main.py --record')
+    parser.add_argument('--resolution', type=render.parse_size, action='append',
+                        help='Internal WIDTHxHEIGHT to render at; repeat it to compare fill rates')
+    parser.add_argument('--output', default='bench_output.json')
+    args = parser.parse_args()
+
+    script, period = (default_script, default_period) if not args.script else load_script(args.script)
+    runs = []
+    for size in args.resolution or [render.design_size]:
+        recording = playback.Recording(args.replay) if args.replay else None
+        results = run(args.level, args.ticks, args.dt, script, period, recording, size)
+        runs.append(results)
+
+        print('%dx%d: %d ticks in %.2fs: %.0f ticks/s' %
+              (*size, results['ticks'], results['seconds'], results['ticks_per_second']))
+        for name, phase in results['phases'].items():
+            print('  %-28s %8d calls %10.2f us/call %8.2f net live blocks/call' %
+                  (name, phase['calls'], phase['mean_us'], phase['net_live_blocks_per_call']))
+        print('  fill: %.0f pixels/frame, %.3f ms/frame drawing, %.1f Mpixels/s' %
+              (results['average_pixels_pushed'], results['draw_ms_per_frame'], results['megapixels_per_second']))
+
+    with open(args.output, 'w') as file:
+        json.dump(runs[0] if len(runs) == 1 else runs, file, indent=2)
+    print('Wrote %s' % args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,272 @@
+import numpy as np
+import pygame
+
+import environment
+from spritesheet import SpriteSheet
+
+
+# Cohen-Sutherland outcodes, as SDL computes them for Rect.clipline
+_inside, _left, _right, _top, _bottom = 0, 1, 2, 4, 8
+_far = np.iinfo(np.int64).max
+
+
+def _trunc_div(a, b):
+    # C integer division, which rounds toward zero
+    q = a // b
+    return np.where((q < 0) & (q * b != a), q + 1, q)
+
+
+def _outcodes(x, y, x1, y1, x2, y2):
+    code = np.where(x < x1, _left, np.where(x > x2, _right, _inside))
+    return code | np.where(y < y1, _top, np.where(y > y2, _bottom, _inside))
+
+
+def clip_segments(sx, sy, ex, ey, rects):
+    """
+    Vectorised Rect.clipline for N segments against M rects.
+    Returns an (N, M) hit mask and the (N, M) point where each segment first enters each rect.
+    """
+    sx, sy, ex, ey = (np.asarray(v, dtype=np.int64)[:, None] for v in (sx, sy, ex, ey))
+    left, top = rects[None, :, 0], rects[None, :, 1]
+    # Inclusive far edges
+    right, bottom = left + rects[None, :, 2] - 1, top + rects[None, :, 3] - 1
+
+    shape = np.broadcast_shapes(sx.shape, left.shape)
+    hit = ~((sx < left) & (ex < left) | (sx > right) & (ex > right) |
+            (sy < top) & (ey < top) | (sy > bottom) & (ey > bottom))
+    hit &= (rects[None, :, 2] > 0) & (rects[None, :, 3] > 0)
+
+    # Horizontal and vertical lines just clamp their start
+    px = np.broadcast_to(sx, shape).copy()
+    py = np.broadcast_to(sy, shape).copy()
+    straight = (sy == ey) | (sx == ex)
+    px = np.where(straight, np.clip(px, left, right), px)
+    py = np.where(straight & (sx == ex) & (sy != ey), np.clip(py, top, bottom), py)
+
+    # Anything else clips its start toward the rect, an edge at a time
+    dx, dy = ex - sx, ey - sy
+    code_end = _outcodes(ex, ey, left, top, right, bottom)
+    active = hit & ~straight
+    for _ in range(4):
+        code = _outcodes(px, py, left, top, right, bottom)
+        done = code == _inside
+        hit &= ~(active & ~done & ((code & code_end) != 0))
+        active &= hit & ~done
+        if not active.any():
+            break
+
+        on_y = (code & (_top | _bottom)) != 0
+        y = np.where(code & _top, top, bottom)
+        x = np.where(code & _left, left, right)
+        safe_dy = np.where(dy == 0, 1, dy)
+        safe_dx = np.where(dx == 0, 1, dx)
+        # Always interpolate from the clipped start, as SDL does
+        cx = np.where(on_y, px + _trunc_div((ex - px) * (y - py), np.where(ey == py, safe_dy, ey - py)), x)
+        cy = np.where(on_y, y, py + _trunc_div((ey - py) * (x - px), np.where(ex == px, safe_dx, ex - px)))
+        px = np.where(active, cx, px)
+        py = np.where(active, cy, py)
+
+    return hit, px, py
+
+
+class CrowdSprite(pygame.sprite.DirtySprite):
+    # Draws one member of a crowd; all of the state lives in the crowd's arrays
+    def __init__(self, crowd, idx):
+        super().__init__()
+        self.crowd = crowd
+        self.idx = idx
+        self.dirty = 2
+        self.image = crowd.frames[crowd.anim[idx]][0]
+        self.rect = self.image.get_rect()
+
+
+class Crowd(object):
+    """
+    Many skaters simulated together, with their state held in NumPy arrays.
+    Gravity, integration and collision against the environment's geo are done for every skater at once,
+    following the same steps as Skater.update. Crowd skaters take no input, so they never grind.
+    """
+    def __init__(self, sheet: SpriteSheet, env, count, gravity=0.0025):
+        self.count = count
+        self.gravity = gravity
+        # The same limit the skater puts on its speed between scenes, in pixels at the sheet's resolution
+        self.max_speed = 10 * sheet.scale
+        self.size = np.array(sheet.rect.size, dtype=np.int64)
+
+        self.position = np.zeros((count, 2))
+        self.last_position = np.zeros((count, 2))
+        self.velocity = np.zeros((count, 2))
+        self.rect = np.zeros((count, 2), dtype=np.int64)
+        self.is_grounded = np.zeros(count, dtype=bool)
+        # Index into the environment's collision list, or -1
+        self.surface = np.full(count, -1, dtype=np.int64)
+        # +1 / -1 on the step a skater leaves the scene to the right / left
+        self.scene_change = np.zeros(count, dtype=np.int8)
+
+        # Animation, by integer id into the sheet's compiled animations
+        self.frames = [[frame.image for frame in anim.frames] for anim in sheet.animations]
+        self.ends = [np.array(anim.ends, dtype=np.float64) for anim in sheet.animations]
+        self.durations = np.array([anim.duration for anim in sheet.animations], dtype=np.float64)
+        self.looping = np.array([anim.looping for anim in sheet.animations], dtype=bool)
+        self.next = np.array([anim.next.id for anim in sheet.animations], dtype=np.int64)
+        self.anim_ids = sheet.animation_ids
+        self.anim = np.full(count, sheet.anim.id, dtype=np.int64)
+        self.anim_time = np.zeros(count)
+        self.frame = np.zeros(count, dtype=np.int64)
+
+        self.set_environment(env)
+
+    def set_environment(self, env):
+        self.env = env
+        self.env_size = env.bounds.size
+        self.rects = np.array([tuple(surf.rect) for surf in env.collision], dtype=np.int64).reshape(-1, 4)
+        self.types = np.array([surf.surftype.value for surf in env.collision], dtype=np.int64)
+        # Surfaces from the old environment mean nothing in the new one
+        self.surface[:] = -1
+        self.is_grounded[:] = False
+
+    def spawn(self, idx, position, velocity):
+        self.position[idx] = position
+        self.last_position[idx] = position
+        self.velocity[idx] = velocity
+        self.rect[idx] = np.round(self.position[idx])
+        self.is_grounded[idx] = False
+        self.surface[idx] = -1
+
+    def make_sprites(self):
+        return [CrowdSprite(self, idx) for idx in range(self.count)]
+
+    def update_sprites(self, sprites, alpha=1.0, camera=(0, 0)):
+        position = self.last_position + (self.position - self.last_position) * alpha
+        position = np.round(position).astype(np.int64) - camera
+        for sprite, (x, y), anim, frame in zip(sprites, position.tolist(), self.anim.tolist(), self.frame.tolist()):
+            sprite.rect.topleft = (x, y)
+            sprite.image = self.frames[anim][frame]
+
+    def animate(self, mask, animation):
+        # Like SpriteSheet.animate, restarting only those not already playing it
+        anim = self.anim_ids[animation]
+        mask = mask & (self.anim != anim)
+        self.anim[mask] = anim
+        self.anim_time[mask] = 0
+        self.frame[mask] = 0
+
+    def update(self, dt):
+        width, height = self.size
+        grounded = self.is_grounded
+
+        # Apply gravity and move, remembering where we started for sweeping and interpolation
+        self.velocity[:, 1] += np.where(grounded, 0.0, self.gravity * dt)
+        self.last_position[:] = self.position
+        start_x = self.rect[:, 0] + width // 2
+        start_y = self.rect[:, 1] + height - 1
+        self.position += self.velocity * dt
+        # np.round rounds halves to even, just like round()
+        self.rect[:] = np.round(self.position)
+        end_x = self.rect[:, 0] + width // 2
+        end_y = self.rect[:, 1] + height - 1
+
+        # Moving off the screen wraps back to the top left of the scene
+        ew, eh = self.env_size
+        x, y = self.rect[:, 0], self.rect[:, 1]
+        off = (x > ew) | (y > eh) | (x < -width)
+        self.scene_change[:] = np.where(x > ew, 1, np.where(x < -width, -1, 0)) * off
+        if off.any():
+            self.position[off] = 0
+            self.last_position[off] = 0
+            self.rect[off] = 0
+            self.velocity[off, 0] = np.clip(self.velocity[off, 0], -self.max_speed, self.max_speed)
+            self.velocity[off, 1] = 0
+            self.animate(off, 'float')
+        live = ~off
+
+        collision = np.full(self.count, -1, dtype=np.int64)
+        if len(self.rects):
+            # Sweep the bottom of each sprite along its path first, so a long step can't tunnel through thin geo
+            moved = live & ~grounded & ((start_x != end_x) | (start_y != end_y))
+            if moved.any():
+                hit, px, py = clip_segments(start_x, start_y, end_x, end_y, self.rects)
+                hit &= moved[:, None]
+                dist = np.where(hit, (px - start_x[:, None]) ** 2 + (py - start_y[:, None]) ** 2, _far)
+                first = np.argmin(dist, axis=1)
+                swept = hit.any(axis=1)
+                rows = np.nonzero(swept)[0]
+                collision[rows] = first[rows]
+                # Back up to where the bottom of the sprite first touched it
+                self.rect[rows, 0] = px[rows, first[rows]] - width // 2
+                self.rect[rows, 1] = py[rows, first[rows]] + 1 - height
+                self.position[rows] = self.rect[rows]
+
+            # Then test the rects themselves, picking the best match as the spatial index does
+            pending = live & (collision < 0)
+            if pending.any():
+                collision = np.where(pending, self._best_overlap(), collision)
+
+        # Hazards knock the skater down, pavement is landed on
+        hits = collision >= 0
+        surftype = np.where(hits, self.types[np.maximum(collision, 0)], 0)
+        self.animate(hits & (surftype == environment.SurfaceType.Hazard.value), 'falling')
+        landing = hits & (surftype == environment.SurfaceType.Pavement.value)
+        if landing.any():
+            self.surface[landing] = collision[landing]
+            self.is_grounded[landing] = True
+            self.velocity[landing, 1] = 0
+            self.rect[landing, 1] = self.rects[collision[landing], 1] - height
+            self.position[landing, 1] = self.rect[landing, 1]
+            self.animate(landing, 'riding')
+
+        # Check whether we're rolling off the ground...
+        rolling = live & ~hits & (self.surface >= 0)
+        if rolling.any():
+            surf = self.rects[np.maximum(self.surface, 0)]
+            # A short drop straight down from the bottom of the sprite, truncated to whole pixels as clipline does
+            foot_x = self.rect[:, 0] + width // 2
+            foot_y = self.rect[:, 1] + height
+            drop_y = np.trunc(foot_y + self.gravity * dt).astype(np.int64)
+            on = (surf[:, 0] <= foot_x) & (foot_x < surf[:, 0] + surf[:, 2]) & \
+                 (np.minimum(foot_y, drop_y) < surf[:, 1] + surf[:, 3]) & (surf[:, 1] <= np.maximum(foot_y, drop_y))
+            departing = rolling & ~on
+            self.is_grounded[departing] = False
+            self.surface[departing] = -1
+
+        self._animate_step(dt, live)
+
+    def _best_overlap(self):
+        # Rect.colliderect for every skater against every rect, then the best match per skater
+        width, height = self.size
+        left, top = self.rect[:, 0:1], self.rect[:, 1:2]
+        right, bottom = left + width, top + height
+        r_left, r_top = self.rects[None, :, 0], self.rects[None, :, 1]
+        r_right, r_bottom = r_left + self.rects[None, :, 2], r_top + self.rects[None, :, 3]
+
+        overlap_w = np.minimum(right, r_right) - np.maximum(left, r_left)
+        overlap_h = np.minimum(bottom, r_bottom) - np.maximum(top, r_top)
+        hit = (overlap_w > 0) & (overlap_h > 0)
+        area = np.where(hit, overlap_w * overlap_h, 0)
+
+        # The uppermost surface whose top edge lies within the rect, else the largest overlap, else the earliest
+        landable = (top <= r_top) & (r_top <= bottom)
+        keys = (np.where(landable, 0, 1), np.where(landable, r_top, 0), -area)
+        best = hit
+        for key in keys:
+            key = np.where(best, key, _far)
+            best &= key == key.min(axis=1, keepdims=True)
+
+        return np.where(hit.any(axis=1), np.argmax(best, axis=1), -1)
+
+    def _animate_step(self, dt, mask):
+        # Catch up on however much time has passed, as SpriteSheet.update does
+        self.anim_time[mask] += dt
+        over = mask & (self.anim_time > self.durations[self.anim])
+        while over.any():
+            looping = over & self.looping[self.anim]
+            self.anim_time[looping] %= self.durations[self.anim[looping]]
+            chained = over & ~looping
+            self.anim_time[chained] -= self.durations[self.anim[chained]]
+            self.anim[chained] = self.next[self.anim[chained]]
+            over = chained & (self.anim_time > self.durations[self.anim])
+
+        for anim in np.unique(self.anim[mask]):
+            members = mask & (self.anim == anim)
+            ends = self.ends[anim]
+            self.frame[members] = np.minimum(np.searchsorted(ends, self.anim_time[members], side='left'), len(ends) - 1)
@@ -0,0 +1,68 @@
+import pygame
+
+
+# Command buffer opcodes
+_line = 0
+_circle = 1
+_rect = 2
+
+
+class DebugDraw(object):
+    """
+    Shapes queued in world coordinates during a frame, drawn together by a DebugOverlay and then forgotten.
+    Call sites check `is_enabled` first, so when it's off they cost an attribute lookup and nothing else.
+    """
+    def __init__(self):
+        self.is_enabled = False
+        self.commands = []
+
+    def enable(self, is_enabled=True):
+        self.is_enabled = is_enabled
+        self.commands.clear()
+
+    def line(self, color, start, end, width=1):
+        self.commands.append((_line, color, (tuple(start), tuple(end)), width))
+
+    def circle(self, color, center, radius, width=0):
+        self.commands.append((_circle, color, (tuple(center), radius), width))
+
+    def rect(self, color, rect, width=1):
+        self.commands.append((_rect, color, pygame.Rect(rect), width))
+
+
+debug = DebugDraw()
+
+
+class DebugOverlay(pygame.sprite.DirtySprite):
+    """
+    Draws a frame's debug commands onto one screen sized layer, in a single pass on top of the world.
+    Like the particles, only the area the shapes covered is cleared and repainted.
+    """
+    def __init__(self, debug: DebugDraw, size):
+        super().__init__()
+        self.debug = debug
+        self.image = pygame.Surface(size, pygame.SRCALPHA)
+        self.rect = pygame.Rect(0, 0, 0, 0)
+        self.source_rect = pygame.Rect(0, 0, 0, 0)
+
+    def redraw(self, camera=(0, 0)):
+        image = self.image
+        image.fill((0, 0, 0, 0), self.source_rect)
+
+        cx, cy = camera
+        drawn = []
+        for op, color, shape, width in self.debug.commands:
+            if op == _line:
+                (x0, y0), (x1, y1) = shape
+                drawn.append(pygame.draw.line(image, color, (x0 - cx, y0 - cy), (x1 - cx, y1 - cy), width))
+            elif op == _circle:
+                (x, y), radius = shape
+                drawn.append(pygame.draw.circle(image, color, (x - cx, y - cy), radius, width))
+            else:
+                drawn.append(pygame.draw.rect(image, color, shape.move(-cx, -cy), width))
+        self.debug.commands.clear()
+
+        bounds = drawn[0].unionall(drawn[1:]).clip(image.get_rect()) if drawn else pygame.Rect(0, 0, 0, 0)
+        self.rect = bounds.copy()
+        self.source_rect = bounds
+        self.dirty = 1
@@ -1,12 +1,17 @@
+import argparse
 import pygame
 from enum import Enum
-import jsonpickle
+import os
+import journal
+import levelpack
 import tkinter as tk
 import tkinter.filedialog as tkfiledialog
-from environment import Environment, Surface, SurfaceType
+from environment import Environment, Surface, SurfaceType, scale_rect
+from spatial import SpatialGrid
+from textcache import text_cache
+import render
 
 
-size = (width, height) = (960, 720)
 nothing = pygame.Color(0, 0, 0, 0)
 red = pygame.Color(255, 0, 0)
 green = pygame.Color(0, 255, 0)
@@ -27,11 +32,13 @@ class Action(Enum):
     Hazardify = 10
 
 
-class EditorGeo(pygame.sprite.Sprite):
+class EditorGeo(pygame.sprite.DirtySprite):
     def __init__(self, geo, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.geo = geo
         self.rect = geo.rect
+        # Stable for the session, so the journal can refer to it
+        self.geo_id = None
 
     def updated(self):
         # Update the underlying geo
@@ -44,6 +51,7 @@ class EditorGeo(pygame.sprite.Sprite):
         self.image.fill(color)
         color.a = 128
         pygame.draw.rect(self.image, color, pygame.Rect((0, 0), self.rect.size), 2)
+        self.dirty = 1
 
     def get_geo(self):
         return Surface(self.geo.surftype, self.rect)
@@ -54,16 +62,37 @@ class State(object):
         self.tk = tk.Tk()
         self.clock = clock
         self.screen = screen
+        # Geo is edited at the screen's resolution, and journaled and saved in design coordinates
+        self.size = screen.get_size()
+        self.scale = render.get_scale(self.size)
         self.font = pygame.font.Font('freesansbold.ttf', 32)
         self.env: Environment = None
-        self.world = pygame.sprite.Group()
+        self.world = pygame.sprite.LayeredDirty()
+        self.renderer = render.Renderer(screen)
         self.tool_geo: EditorGeo = None
         self.tool_action = Action.Select
         self.tool_offset = pygame.math.Vector2()
         self.tool_string = ''
-        self.tool_surface: pygame.Surface = None
-        self.tool_rect: pygame.Rect = None
-        self.geo = set()
+        self.tool_label = pygame.sprite.DirtySprite()
+        # Geo in z-order, bottom to top, and indexed for hit-testing
+        self.geo = []
+        self.geo_index = SpatialGrid(())
+        self.geo_by_id = {}
+        self.next_geo_id = 0
+
+        # Every edit is appended to the level's journal, which is flushed every so often
+        # and compacted into the level pack once it grows long
+        self.journal: journal.Journal = None
+        self.drag_start = None
+        self.autosave_interval = 1000
+        self.autosave_time = 0
+        self.compact_after = 256
+
+        # One outline surface, drawn into while dragging out a resize instead of refilling the geo per motion event
+        self.drag_outline = pygame.sprite.DirtySprite()
+        self.drag_outline.image = pygame.surface.Surface(self.size, pygame.SRCALPHA)
+        self.drag_outline.source_rect = pygame.Rect(0, 0, 0, 0)
+        self.drag_outline.rect = pygame.Rect(0, 0, 0, 0)
 
         # Action palette
         self.tools = pygame.sprite.Group()
@@ -79,7 +108,7 @@ class State(object):
         self.load('assets/Cow.json')
 
     def create_tool(self, name: str, action: Action):
-        sprite = pygame.sprite.Sprite()
+        sprite = pygame.sprite.DirtySprite()
         sprite.image = pygame.image.load('assets/editor/%s.png' % name).convert_alpha()
         sprite.rect = sprite.image.get_rect()
 
@@ -90,21 +119,98 @@ class State(object):
         self.tool_palette_pos.x += sprite.rect.width + 8
 
         self.tools.add(sprite)
+        self.world.add(sprite, layer=render.hud_layer)
 
 
     def load(self, filename):
+        if self.journal:
+            self.journal.close()
         self.world.remove(self.geo)
         self.world.remove(self.env)
         self.geo.clear()
+        self.geo_index = SpatialGrid(())
+        self.geo_by_id.clear()
+        self.next_geo_id = 0
 
-        self.env = Environment(filename, size)
+        self.env = Environment(filename, self.size)
         for geo in self.env.geo:
-            sprite = EditorGeo(geo)
+            self._insert_geo(EditorGeo(geo))
+
+        self.world.add(self.env, layer=render.background_layer)
+        self.renderer.invalidate()
+
+        # Pick up any edits made since the level was last saved in full
+        self.journal = journal.Journal(journal.get_journal_filename(filename), self._get_base_stamp())
+        commands = self.journal.open()
+        for command in commands:
+            self.apply(command)
+        if commands:
+            print('Recovered %d edits from %s' % (len(commands), self.journal.filename))
+
+    def _get_base_stamp(self):
+        # The journal applies on top of whichever file the environment loaded its geo from
+        pack = levelpack.get_pack_filename(self.env.filename)
+        if os.path.exists(pack) and not levelpack.is_stale(self.env.filename, pack):
+            return journal.get_stamp(pack)
+        return journal.get_stamp(self.env.info['geo'])
+
+    def _insert_geo(self, sprite, geo_id=None):
+        sprite.geo_id = self.next_geo_id if geo_id is None else geo_id
+        self.next_geo_id = max(self.next_geo_id, sprite.geo_id + 1)
+        sprite.updated()
+        self.geo.append(sprite)
+        self.geo_index.insert(sprite)
+        self.geo_by_id[sprite.geo_id] = sprite
+        self.world.add(sprite, layer=render.sprite_layer)
+        return sprite
+
+    def to_level(self, rect):
+        return tuple(scale_rect(rect, 1 / self.scale))
+
+    def apply(self, command):
+        # Carry out a journal command, whether it's a fresh edit, an undo / redo or a replay
+        op, geo_id, a, b = command
+        if op == journal.Add:
+            self._insert_geo(EditorGeo(Surface(SurfaceType(a), scale_rect(b, self.scale))), geo_id)
+        elif op == journal.Remove:
+            sprite = self.geo_by_id.pop(geo_id)
+            self.geo.remove(sprite)
+            self.geo_index.remove(sprite)
+            self.world.remove(sprite)
+        elif op == journal.Resize:
+            sprite = self.geo_by_id[geo_id]
+            sprite.rect.update(scale_rect(b, self.scale))
             sprite.updated()
-            self.geo.add(sprite)
+            self.geo_index.move(sprite)
+        elif op == journal.Retype:
+            sprite = self.geo_by_id[geo_id]
+            sprite.geo.surftype = SurfaceType(b)
+            sprite.updated()
+
+    def do(self, command):
+        self.apply(command)
+        self.journal.record(command)
+
+    def retype(self, geo, surftype):
+        if geo.geo.surftype != surftype:
+            self.do((journal.Retype, geo.geo_id, geo.geo.surftype.value, surftype.value))
+
+    def save(self):
+        # Write the whole level, after which the journal can start over
+        print('Saving %s...' % levelpack.get_pack_filename(self.env.filename))
+        self.env.save_pack([geo.get_geo() for geo in self.geo])
+        self.journal.compact(self._get_base_stamp())
 
-        self.world.add(self.env)
-        self.world.add(self.geo)
+    def autosave(self, dt):
+        self.autosave_time += dt
+        if self.autosave_time < self.autosave_interval:
+            return
+
+        self.autosave_time = 0
+        if self.journal.count >= self.compact_after:
+            self.save()
+        else:
+            self.journal.flush()
 
     def _get_tool_under_cursor(self):
         pos = pygame.mouse.get_pos()
@@ -113,12 +219,40 @@ class State(object):
                 return tool
 
     def _get_geo_under_cursor(self):
-        pos = pygame.mouse.get_pos()
-        for geo in self.geo:
-            if geo.rect.collidepoint(pos):
-                return geo
+        # The topmost geo under the cursor, which is also the last one drawn
+        hits = self.geo_index.query_point_all(pygame.mouse.get_pos())
+        return hits[-1] if hits else None
+
+    def start_drag(self, geo):
+        # Hide the filled geo and show just its outline until the drag is done
+        geo.visible = 0
+        self.drag_outline.source_rect.update(0, 0, 0, 0)
+        self.world.add(self.drag_outline, layer=render.overlay_layer)
+        self.drag(geo)
+
+    def drag(self, geo):
+        outline = self.drag_outline
+        outline.image.fill(nothing, outline.source_rect)
+
+        rect = geo.rect.copy()
+        rect.normalize()
+        area = pygame.Rect((0, 0), rect.size).clip(outline.image.get_rect())
+        color = pygame.Color(geo.geo.get_editor_color())
+        color.a = 128
+        pygame.draw.rect(outline.image, color, area, 2)
+
+        outline.source_rect.update(area)
+        outline.rect.update(rect.topleft, area.size)
+        outline.dirty = 1
+
+    def end_drag(self, geo):
+        self.world.remove(self.drag_outline)
+        geo.rect.normalize()
+        geo.visible = 1
+        geo.updated()
 
     _corner_threshold = 64
+    _resize_actions = (Action.Resize_SE, Action.Resize_NW, Action.Resize_NE, Action.Resize_SW)
 
     def _check_corner(self, pos, corner, action):
         corner = pygame.math.Vector2(corner)
@@ -159,31 +293,32 @@ class State(object):
             pos = pygame.math.Vector2(pygame.mouse.get_pos())
             if self.tool_action == Action.Move:
                 self.tool_geo.rect.center = pos + self.tool_offset
+                self.tool_geo.dirty = 1
             elif self.tool_action == Action.Resize_SE:
                 topleft = pygame.math.Vector2(self.tool_geo.rect.topleft)
                 self.tool_geo.rect.size = pos - topleft + self.tool_offset
-                self.tool_geo.updated()
+                self.drag(self.tool_geo)
             elif self.tool_action == Action.Resize_NE:
                 bottomleft = pygame.math.Vector2(self.tool_geo.rect.bottomleft)
                 size = pos - bottomleft + self.tool_offset
                 size.y = -size.y
                 self.tool_geo.rect.size = size
                 self.tool_geo.rect.bottomleft = bottomleft
-                self.tool_geo.updated()
+                self.drag(self.tool_geo)
             elif self.tool_action == Action.Resize_NW:
                 bottomright = pygame.math.Vector2(self.tool_geo.rect.bottomright)
                 size = pos - bottomright + self.tool_offset
                 size *= -1
                 self.tool_geo.rect.size = size
                 self.tool_geo.rect.bottomright = bottomright
-                self.tool_geo.updated()
+                self.drag(self.tool_geo)
             elif self.tool_action == Action.Resize_SW:
                 topright = pygame.math.Vector2(self.tool_geo.rect.topright)
                 size = pos - topright + self.tool_offset
                 size.x = -size.x
                 self.tool_geo.rect.size = size
                 self.tool_geo.rect.topright = topright
-                self.tool_geo.updated()
+                self.drag(self.tool_geo)
             else:
                 tool = self._get_tool_under_cursor()
                 geo = self._get_geo_under_cursor()
@@ -202,28 +337,37 @@ class State(object):
                 self.tool_geo = self._get_geo_under_cursor()
                 if self.tool_action == Action.Select:
                     self.tool_action, self.tool_offset = self._detect_geo_corner_under_cursor(self.tool_geo)
+                    if self.tool_geo:
+                        self.drag_start = tuple(self.tool_geo.rect)
+                    if self.tool_action in self._resize_actions:
+                        self.start_drag(self.tool_geo)
                 elif self.tool_action == Action.Pavify:
-                    self.tool_geo.geo.surftype = SurfaceType.Pavement
-                    self.tool_geo.updated()
+                    self.retype(self.tool_geo, SurfaceType.Pavement)
                 elif self.tool_action == Action.Ledgify:
-                    self.tool_geo.geo.surftype = SurfaceType.Ledge
-                    self.tool_geo.updated()
+                    self.retype(self.tool_geo, SurfaceType.Ledge)
                 elif self.tool_action == Action.Hazardify:
-                    self.tool_geo.geo.surftype = SurfaceType.Hazard
-                    self.tool_geo.updated()
+                    self.retype(self.tool_geo, SurfaceType.Hazard)
                 elif self.tool_action == Action.Remove:
-                    self.geo.remove(self.tool_geo)
-                    self.world.remove(self.tool_geo)
+                    geo = self.tool_geo
+                    self.do((journal.Remove, geo.geo_id, geo.geo.surftype.value, self.to_level(geo.rect)))
                     self.tool_geo = None
                 elif self.tool_action == Action.Add:
-                    pos = pygame.math.Vector2(pygame.mouse.get_pos())
-                    self.tool_geo = EditorGeo(Surface(SurfaceType.Pavement, pos, (32, 32)))
-                    self.tool_geo.updated()
-                    self.geo.add(self.tool_geo)
-                    self.world.add(self.tool_geo)
+                    x, y = pygame.mouse.get_pos()
+                    geo_id = self.next_geo_id
+                    x, y, _, _ = self.to_level((x, y, 0, 0))
+                    self.do((journal.Add, geo_id, SurfaceType.Pavement.value, (x, y, 32, 32)))
+                    self.tool_geo = self.geo_by_id[geo_id]
 
         elif event.type == pygame.MOUSEBUTTONUP:
-            if self.tool_action in (Action.Move, Action.Resize_SE, Action.Resize_NW, Action.Resize_NE, Action.Resize_SW):
+            if self.tool_action in self._resize_actions:
+                # Only now is the filled surface rebuilt, at its final size
+                self.end_drag(self.tool_geo)
+            if self.tool_action == Action.Move or self.tool_action in self._resize_actions:
+                self.geo_index.move(self.tool_geo)
+                # The geo has already been moved live; just note where it went
+                if tuple(self.tool_geo.rect) != self.drag_start:
+                    self.journal.record((journal.Resize, self.tool_geo.geo_id, self.to_level(self.drag_start),
+                                         self.to_level(self.tool_geo.rect)))
                 self.tool_action = Action.Select
             self.tool_offset.update(0, 0)
             self.tool_geo = None
@@ -235,10 +379,11 @@ class State(object):
             if event.mod & pygame.KMOD_CTRL:
                 # Control keys
                 if key == 's':
-                    print('Saving %s...' % self.env.info['geo'])
-                    env_geo = [geo.get_geo() for geo in self.geo]
-                    with open(self.env.info['geo'], 'w') as geo_file:
-                        geo_file.write(jsonpickle.encode(env_geo))
+                    self.save()
+                elif key == 'z' and event.mod & pygame.KMOD_SHIFT or key == 'y':
+                    self.journal.redo(self.apply)
+                elif key == 'z':
+                    self.journal.undo(self.apply)
                 elif key == 'o':
                     filename = tkfiledialog.askopenfilename()
                     if filename:
@@ -262,26 +407,23 @@ class State(object):
     }
 
     def update_tool(self, geo):
-        # Cannot reuse font surfaces - must destroy and recreate
-        if self.tool_surface:
-            self.world.remove(self.tool_surface)
-
         if type(geo) is EditorGeo:
             self.tool_string = '%s %s' % (self.tool_action, geo.geo.surftype)
         else:
             self.tool_string = geo.tool_name
 
-        self.tool_surface = self.font.render(self.tool_string, True, green.lerp(red, 0.5))
-        self.tool_rect = self.tool_surface.get_rect()
-        self.tool_rect.center = (width / 2, self.tool_rect.height)
+        self.tool_label.image = text_cache.render(self.font, self.tool_string, green.lerp(red, 0.5))
+        self.tool_label.rect = self.tool_label.image.get_rect()
+        self.tool_label.rect.center = (self.size[0] / 2, self.tool_label.rect.height)
+        self.tool_label.dirty = 1
+        self.world.add(self.tool_label, layer=render.hud_layer)
 
         action, _ = self._detect_geo_corner_under_cursor(geo)
         pygame.mouse.set_cursor(self._action_cursors[action])
 
     def clear_tool(self):
         self.tool_string = ''
-        self.world.remove(self.tool_surface)
-        self.tool_surface = None
+        self.world.remove(self.tool_label)
 
         pygame.mouse.set_cursor(pygame.SYSTEM_CURSOR_ARROW)
 
@@ -298,25 +440,18 @@ def editor_tick(state, dt):
         else:
             state.handle(event)
 
-    state.screen.fill('black')
+    state.autosave(dt)
 
+    # The tools are part of the world, drawn over the geo
     state.world.update(dt, state)
-    state.world.draw(state.screen)
-
-    state.tools.update(dt, state)
-    state.tools.draw(state.screen)
-
-    if state.tool_surface:
-        state.screen.blit(state.tool_surface, state.tool_rect)
-
-    pygame.display.flip()
+    state.renderer.draw(state.world)
 
     return True
 
 
-def main():
+def main(resolution=render.design_size):
     pygame.init()
-    screen = pygame.display.set_mode(size)
+    screen = render.set_mode(resolution)
     pygame.display.set_caption('Mike Slegeir\'s Gnar Editor')
     clock = pygame.time.Clock()
     state = State(clock, screen)
@@ -327,10 +462,14 @@ def main():
         lt = t
         t = pygame.time.get_ticks()
 
+    state.journal.close()
     pygame.quit()
 
 
 if __name__ == '__main__':
     import code
     #code.interact(local=locals())
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resolution', type=render.parse_size, default=render.design_size,
+                        help='Edit at WIDTHxHEIGHT, stretched to the window')
+    main(parser.parse_args().resolution)
@@ -1,7 +1,15 @@
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum, IntEnum
 import json
 import jsonpickle
+import os
 import pygame
+import heightfield
+import levelpack
+from loadcache import LoadCache
+import render
+from spatial import SpatialGrid
+from profiler import profiler
 
 
 class SurfaceType(Enum):
@@ -25,42 +33,196 @@ class Surface(object):
         return self._surftypecolors[self.surftype]
 
 
-class Environment(pygame.sprite.Sprite):
+def scale_rect(rect, scale):
+    # Edges are scaled rather than sizes, so surfaces which met still meet
+    rect = pygame.Rect(rect)
+    if scale == 1:
+        return rect
+    left, top = round(rect.left * scale), round(rect.top * scale)
+    return pygame.Rect(left, top, round(rect.right * scale) - left, round(rect.bottom * scale) - top)
+
+
+def scale_geo(geo, scale):
+    # Geo is authored in design coordinates, and played in internal ones
+    return [Surface(surface.surftype, scale_rect(surface.rect, scale)) for surface in geo]
+
+
+def load_legacy_geo(filename):
+    # jsonpickle geo files predate level packs and are only read as a fallback
+    with open(filename) as geo_file:
+        return jsonpickle.decode(geo_file.read())
+
+
+class Environment(pygame.sprite.DirtySprite):
     def __init__(self, info, size):
         # Construct the base sprite and load our configuration
-        pygame.sprite.Sprite.__init__(self)
+        pygame.sprite.DirtySprite.__init__(self)
         self.filename = info
+        self.scale = render.get_scale(size)
+        # Art scaled for this resolution is kept on disk, so it's only ever scaled once
+        cache = levelpack.get_pack_filename(info, size)
+        pack = levelpack.get_pack_filename(info)
+        if cache != pack and self._is_fresh(info, cache):
+            self._load_pack(cache, size)
+        else:
+            if self._is_fresh(info, pack):
+                self._load_pack(pack, size)
+            else:
+                self._load_legacy(info, size)
+            if cache != pack:
+                self._save_cache(cache)
+
+        self.rect = self.image.get_rect()
+        # The extent of the level in world coordinates, and the part of it on screen - a single screen here
+        self.bounds = self.rect.copy()
+        self.camera = (0, 0)
+        self.set_geo(self.geo)
+
+    def set_geo(self, geo):
+        self.geo = geo
+        self.collision = [geo for geo in self.geo if geo.surftype != SurfaceType.Ledge]
+        self.ledges = [geo for geo in self.geo if geo.surftype == SurfaceType.Ledge]
+
+        # Static indices, so per-frame queries don't scale with the size of the level
+        self.collision_index = SpatialGrid(self.collision)
+        self.ledge_index = SpatialGrid(self.ledges)
+        # The shape of the ground along each column, for riding ramps
+        self.heightfield = heightfield.get_heightfield(self)
+
+    @staticmethod
+    def _is_fresh(info, pack):
+        return os.path.exists(pack) and not levelpack.is_stale(info, pack)
+
+    def _load_pack(self, filename, size):
+        pack = levelpack.load(filename)
+        self.info = pack.info
+
+        # The art is usually compiled at the size we want, in which case there's nothing to scale
+        self.image = pack.get_art().convert()
+        if self.image.get_size() != tuple(size):
+            self.image = pygame.transform.scale(self.image, size)
+
+        self.geo = scale_geo([Surface(SurfaceType(surftype), *rect) for surftype, rect in pack.iter_geo()], self.scale)
+
+    def _load_legacy(self, info, size):
         with open(info, 'r') as file:
             self.info = json.load(file)
 
         # Load in the art and geometry images
         self.image = pygame.image.load(self.info['art']).convert()
         self.image = pygame.transform.scale(self.image, size)
-        self.rect = self.image.get_rect()
-        with open(self.info['geo']) as geo_file:
-            self.geo = jsonpickle.decode(geo_file.read())
-
-        self.collision = [geo for geo in self.geo if geo.surftype != SurfaceType.Ledge]
-        self.ledges = [geo for geo in self.geo if geo.surftype == SurfaceType.Ledge]
+        self.geo = scale_geo(load_legacy_geo(self.info['geo']), self.scale)
+
+    def _get_level_geo(self, geo):
+        # Back into design coordinates, for saving
+        return [(geo.surftype.value, tuple(scale_rect(geo.rect, 1 / self.scale))) for geo in geo]
+
+    def _save_cache(self, filename):
+        try:
+            levelpack.save(filename, self.info, self._get_level_geo(self.geo), self.image)
+        except OSError as error:
+            # Only a cache; the level's loaded regardless
+            print('Couldn\'t cache %s: %s' % (filename, error))
+
+    def save_pack(self, geo=None):
+        geo = self.geo if geo is None else geo
+        # The level's own pack keeps its art at the design resolution, whatever this one's playing at
+        art = self.image
+        if self.scale != 1:
+            art = pygame.transform.scale(pygame.image.load(self.info['art']), render.design_size)
+        levelpack.save(levelpack.get_pack_filename(self.filename), self.info, self._get_level_geo(geo), art)
 
     def get_surface_at(self, rect) -> Surface:
-        for idx in rect.collidelistall(self.collision):
-            surf = self.collision[idx]
-            # TODO: Here I can do more refined testing for collisions with ramps
-            return surf
-
-        return None
+        with profiler.scope('Environment.get_surface_at'):
+            return self.collision_index.query_rect(rect)
 
     def get_ledge_at(self, rect) -> Surface:
-        for idx in rect.collidelistall(self.ledges):
-            surf = self.ledges[idx]
-            # TODO: Here I can do more refined testing for collisions with ramps
-            return surf
+        with profiler.scope('Environment.get_ledge_at'):
+            return self.ledge_index.query_rect(rect)
+
+    def get_surface_along(self, start, end):
+        # Returns the first surface the segment enters, and where
+        with profiler.scope('Environment.get_surface_along'):
+            return self.collision_index.query_segment(start, end)
+
+    def get_ledge_along(self, start, end):
+        with profiler.scope('Environment.get_ledge_along'):
+            return self.ledge_index.query_segment(start, end)
+
+    def get_ground_height(self, x, surface):
+        # Where the top of a surface is in this column - its rect's top, unless it's sloped there
+        return self.heightfield.get_height(x, self.collision_index.indices.get(surface), surface.rect.top)
+
+    def get_ground_slope(self, x, surface):
+        return self.heightfield.get_slope(x, self.collision_index.indices.get(surface))
 
-        return None
+    def follow(self, rect, velocity):
+        # A single screen level never scrolls
+        pass
 
     def get_next(self):
         return self.info.get('next')
 
     def get_prev(self):
         return self.info.get('prev')
+
+    def get_memory_size(self):
+        # The art dominates - the geo is a handful of rects
+        return self.image.get_bytesize() * self.image.get_width() * self.image.get_height()
+
+    def close(self):
+        # Nothing's held open; tiled levels release their tile file and workers
+        pass
+
+
+def is_tiled(info):
+    # Levels whose info names a tile file, or the sections to compile one from, stream their art and geo from it
+    return bool(info.get('tiles') or info.get('sections'))
+
+
+def load(filename, size) -> Environment:
+    with open(filename, 'r') as file:
+        info = json.load(file)
+    if is_tiled(info):
+        # Imported here since tiled environments build on this module
+        from tiles import TiledEnvironment
+        return TiledEnvironment(filename, size)
+    return Environment(filename, size)
+
+
+class EnvironmentCache(object):
+    """
+    Keeps recently used environments resident, up to a memory budget.
+    Neighbouring scenes can be prefetched on a worker thread so that a scene transition
+    only has to swap in an environment which has already been decoded.
+    """
+    def __init__(self, size, budget=64 * 1024 * 1024, workers=1):
+        self.size = size
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='env-prefetch')
+        self.cache = LoadCache(self._load, lambda env: env.get_memory_size(), budget, self.executor,
+                               on_evict=lambda env: env.close())
+
+    def _load(self, filename):
+        return load(filename, self.size)
+
+    def get(self, filename) -> Environment:
+        # The one handed out is in play, so it's kept open however much gets prefetched around it
+        self.cache.pinned = {filename}
+        return self.cache.get(filename)
+
+    def prefetch(self, *filenames):
+        self.cache.prefetch(filenames)
+
+    def wait(self, *filenames):
+        self.cache.wait(filenames)
+
+    def is_loading(self, filename):
+        return self.cache.is_loading(filename)
+
+    def poll(self):
+        self.cache.poll()
+
+    def close(self):
+        # Let any load already underway finish, so that it's closed along with everything resident
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.cache.clear()
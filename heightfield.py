@@ -0,0 +1,209 @@
+from array import array
+import math
+import os
+import struct
+import sys
+import pygame
+import render
+
+
+# Layout: header, then per column the owning surface (an index into the environment's collision list, or -1),
+# the height of the ground's top edge, its slope (dy / dx) and its upward normal
+_magic = b'MSGH'
+_version = 1
+_header = struct.Struct('<4sHI')
+_none = -1
+
+# Ground in a geo image is drawn in the editor's pavement colour
+ground_color = (0, 255, 0)
+
+
+class Heightfield(object):
+    """
+    The top edge of the ground in every column of a level, with its slope and normal,
+    so ramps can be ridden with a lookup per x position rather than any mask testing.
+    Columns are owned by the pavement surface whose top they describe.
+    """
+    def __init__(self, width, owners, heights, slopes, normals_x, normals_y):
+        self.width = width
+        self.owners = owners
+        self.heights = heights
+        self.slopes = slopes
+        self.normals_x = normals_x
+        self.normals_y = normals_y
+
+    def _column(self, x, owner):
+        x = int(x)
+        if 0 <= x < self.width and owner is not None and self.owners[x] == owner:
+            return x
+        return None
+
+    def get_height(self, x, owner, default):
+        # Where the owner's top edge is in this column, or the default if the column belongs to something else
+        x = self._column(x, owner)
+        return default if x is None else self.heights[x]
+
+    def get_slope(self, x, owner):
+        x = self._column(x, owner)
+        return 0.0 if x is None else self.slopes[x]
+
+    def get_normal(self, x, owner):
+        x = self._column(x, owner)
+        return (0.0, -1.0) if x is None else (self.normals_x[x], self.normals_y[x])
+
+    @classmethod
+    def build(cls, size, surfaces, ramps=(), heightmap=None):
+        """
+        Starts from the flat top of every pavement rect - the uppermost wins a column - then lets sloped entries
+        and the topmost ground pixels of a geo image reshape the surface whose rect they fall within.
+        Ramps are [x0, y0, x1, y1] lines along the ground, in level coordinates.
+        """
+        from environment import SurfaceType
+
+        width, height = size
+        owners = array('h', [_none]) * width
+        heights = array('f', [math.inf]) * width
+
+        pavement = [(idx, surface.rect) for idx, surface in enumerate(surfaces)
+                    if surface.surftype == SurfaceType.Pavement]
+        for idx, rect in pavement:
+            for x in range(max(rect.left, 0), min(rect.right, width)):
+                if rect.top < heights[x]:
+                    owners[x], heights[x] = idx, rect.top
+
+        def reshape(x, y):
+            # A refined height only counts within a surface, and only for the surface it's within
+            for idx, rect in pavement:
+                if rect.left <= x < rect.right and rect.top <= y < rect.bottom:
+                    owners[x], heights[x] = idx, y
+                    return
+
+        if heightmap:
+            for x, y in _scan_tops(heightmap, size):
+                reshape(x, y)
+
+        for x0, y0, x1, y1 in ramps:
+            if x1 < x0:
+                x0, y0, x1, y1 = x1, y1, x0, y0
+            for x in range(max(int(x0), 0), min(int(x1), width - 1) + 1):
+                reshape(x, y0 + (y1 - y0) * (x - x0) / max(x1 - x0, 1))
+
+        slopes = array('f', [0.0]) * width
+        normals_x = array('f', [0.0]) * width
+        normals_y = array('f', [-1.0]) * width
+        for x in range(width):
+            owner = owners[x]
+            if owner == _none:
+                continue
+            # Central differences within the same surface, one-sided at its ends
+            left = x - 1 if x > 0 and owners[x - 1] == owner else x
+            right = x + 1 if x + 1 < width and owners[x + 1] == owner else x
+            if right != left:
+                slope = (heights[right] - heights[left]) / (right - left)
+                length = math.hypot(slope, 1.0)
+                slopes[x], normals_x[x], normals_y[x] = slope, slope / length, -1.0 / length
+
+        return cls(width, owners, heights, slopes, normals_x, normals_y)
+
+
+def _scan_tops(image, size):
+    # The topmost ground pixel of every column of a geo image, scaled to the level's size
+    source_width, source_height = image.get_size()
+    data = pygame.image.tobytes(image, 'RGB')
+    pixel = bytes(ground_color)
+    pitch = source_width * 3
+
+    tops = {}
+    for y in range(source_height):
+        row = data[y * pitch:(y + 1) * pitch]
+        at = row.find(pixel)
+        while at >= 0:
+            if at % 3 == 0:
+                tops.setdefault(at // 3, y)
+            at = row.find(pixel, at + 1)
+        if len(tops) == source_width:
+            break
+
+    width, height = size
+    for x in range(width):
+        top = tops.get(x * source_width // width)
+        if top is not None:
+            yield x, top * height / source_height
+
+
+def get_heightfield_filename(info, size=None):
+    # Columns are per internal pixel, so each resolution has its own
+    return os.path.splitext(info)[0] + render.get_size_suffix(size) + '.heights'
+
+
+def scale_ramps(ramps, scale):
+    # Ramps are written in design coordinates
+    return [[value * scale for value in ramp] for ramp in ramps]
+
+
+def is_stale(filename, sources):
+    if not os.path.exists(filename):
+        return True
+    cache_time = os.path.getmtime(filename)
+    return any(os.path.exists(source) and os.path.getmtime(source) > cache_time for source in sources)
+
+
+def load(filename) -> Heightfield:
+    with open(filename, 'rb') as file:
+        data = file.read()
+
+    magic, version, width = _header.unpack_from(data)
+    if magic != _magic or version != _version:
+        raise ValueError('%s is not a version %d heightfield' % (filename, _version))
+
+    offset = _header.size
+    columns = []
+    for typecode in ('h', 'f', 'f', 'f', 'f'):
+        column = array(typecode)
+        column.frombytes(data[offset:offset + column.itemsize * width])
+        if sys.byteorder != 'little':
+            column.byteswap()
+        offset += column.itemsize * width
+        columns.append(column)
+    if len(columns[-1]) != width:
+        raise ValueError('%s is truncated' % filename)
+
+    return Heightfield(width, *columns)
+
+
+def save(filename, field: Heightfield):
+    # Write beside the target and swap in, so a reader never sees half a table
+    temp = filename + '.tmp'
+    with open(temp, 'wb') as file:
+        file.write(_header.pack(_magic, _version, field.width))
+        for column in (field.owners, field.heights, field.slopes, field.normals_x, field.normals_y):
+            if sys.byteorder != 'little':
+                column = array(column.typecode, column)
+                column.byteswap()
+            file.write(column.tobytes())
+    os.replace(temp, filename)
+
+
+def get_heightfield(env) -> Heightfield:
+    """
+    The environment's heightfield. Levels of plain rects build theirs on the spot; levels with a geo image
+    or ramps cache theirs next to the level, rebuilt whenever anything it came from changes.
+    """
+    info = env.info
+    heightmap, ramps = info.get('heightmap'), scale_ramps(info.get('ramps', ()), env.scale)
+    if not heightmap and not ramps:
+        return Heightfield.build(env.bounds.size, env.collision)
+
+    filename = get_heightfield_filename(env.filename, env.rect.size)
+    # Imported here since the environment depends on this module for loading
+    import levelpack
+    sources = [env.filename, levelpack.get_pack_filename(env.filename), info.get('geo'), heightmap]
+    if not is_stale(filename, [source for source in sources if source]):
+        field = load(filename)
+        if field.width == env.bounds.width:
+            return field
+
+    image = pygame.image.load(heightmap) if heightmap else None
+    field = Heightfield.build(env.bounds.size, env.collision, ramps, image)
+    save(filename, field)
+    return field
@@ -0,0 +1,189 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import json
+import os
+import struct
+import zlib
+import pygame
+import environment
+import levelpack
+from environment import Surface, SurfaceType
+from profiler import profiler
+
+
+# What a file that's still being written tends to look like to each decoder
+_decode_errors = (pygame.error, ValueError, EOFError, OSError, struct.error, IndexError, KeyError)
+
+
+def get_stamp(filename):
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+class Reload(object):
+    # The parts of a level which changed, decoded and ready to swap in
+    __slots__ = ('from_pack', 'info', 'geo', 'art', 'art_crc')
+
+    def __init__(self):
+        self.from_pack = False
+        self.info = None
+        self.geo = None
+        self.art = None
+        self.art_crc = None
+
+
+class HotReloader(object):
+    """
+    Watches the files behind the active environment and swaps in whatever part of them changed.
+    Polling is a handful of stats every so often. A change must hold still for a whole interval before it's read,
+    decoding happens on a worker thread, and anything which fails to decode is retried on the next change.
+    """
+    def __init__(self, interval=250):
+        self.interval = interval
+        self.time = 0
+        self.env = None
+        # Role ('info', 'pack', 'art' or 'geo') -> filename, and the last stamp of each which was read
+        self.files = {}
+        self.stamps = {}
+        # Stamps seen changing, waiting to settle
+        self.changing = {}
+        self.changed = set()
+        self.future = None
+        self.from_pack = False
+        self.art_crc = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='hot-reload')
+
+    def watch(self, env):
+        self.env = env
+        self.files = {}
+        self.changing.clear()
+        self.changed.clear()
+        self.future = None
+        self.art_crc = None
+
+        # Tiled levels are streamed from their own compiled file, and not reloaded
+        if environment.is_tiled(env.info):
+            return
+
+        self.files['info'] = env.filename
+        self.files['pack'] = levelpack.get_pack_filename(env.filename)
+        for role in ('art', 'geo'):
+            if env.info.get(role):
+                self.files[role] = env.info[role]
+        self.stamps = {role: get_stamp(filename) for role, filename in self.files.items()}
+        self.from_pack = self._is_pack_fresh(env.filename)
+        # Note what the packed art is now, in the background, so a later save can tell whether it changed
+        self.art_crc = self.executor.submit(self._get_art_crc, self.files['pack'])
+
+    @staticmethod
+    def _is_pack_fresh(info):
+        # The same choice Environment makes between its pack and the files it's compiled from
+        pack = levelpack.get_pack_filename(info)
+        return os.path.exists(pack) and not levelpack.is_stale(info, pack)
+
+    @staticmethod
+    def _get_art_crc(filename):
+        try:
+            return zlib.crc32(levelpack.load(filename).art)
+        except _decode_errors:
+            return None
+
+    def poll(self, dt):
+        """
+        Call once a frame. Returns the environment if it was just updated, so anything derived from it can follow.
+        """
+        if not self.files:
+            return None
+
+        with profiler.scope('HotReloader.poll'):
+            if self.future and self.future.done():
+                return self._apply()
+
+            self.time += dt
+            if self.time < self.interval:
+                return None
+            self.time = 0
+
+            for role, filename in self.files.items():
+                stamp = get_stamp(filename)
+                if stamp == self.stamps[role]:
+                    self.changing.pop(role, None)
+                elif self.changing.get(role) != stamp:
+                    # Still being written, perhaps - look again next time
+                    self.changing[role] = stamp
+                else:
+                    del self.changing[role]
+                    self.stamps[role] = stamp
+                    self.changed.add(role)
+
+            if self.changed and not self.changing and not self.future:
+                self.future = self.executor.submit(self._decode, self.env, set(self.changed), self.from_pack,
+                                                   self.art_crc)
+                self.changed.clear()
+
+        return None
+
+    def _decode(self, env, changed, from_pack, art_crc):
+        # On the worker thread: read only what changed
+        reload = Reload()
+        info = env.filename
+        if 'info' in changed:
+            with open(info, 'r') as file:
+                reload.info = json.load(file)
+
+        reload.from_pack = self._is_pack_fresh(info)
+        if reload.from_pack:
+            level = levelpack.load(levelpack.get_pack_filename(info))
+            reload.geo = environment.scale_geo([Surface(SurfaceType(surftype), *rect)
+                                                for surftype, rect in level.iter_geo()], env.scale)
+            # Saving geo from the editor rewrites the art alongside it - only decode it if it's different
+            reload.art_crc = zlib.crc32(level.art)
+            if reload.art_crc != (art_crc.result() if art_crc else None):
+                reload.art = self._fit(level.get_art(), env)
+        else:
+            # Falling back from the pack means everything may have changed
+            sources = reload.info or env.info
+            if 'geo' in changed or from_pack:
+                reload.geo = environment.scale_geo(environment.load_legacy_geo(sources['geo']), env.scale)
+            if 'art' in changed or from_pack:
+                reload.art = self._fit(pygame.image.load(sources['art']), env)
+
+        return reload
+
+    @staticmethod
+    def _fit(image, env):
+        image = image.convert()
+        if image.get_size() != env.rect.size:
+            image = pygame.transform.scale(image, env.rect.size)
+        return image
+
+    def _apply(self):
+        future, self.future = self.future, None
+        try:
+            reload = future.result()
+        except _decode_errors as error:
+            # Most likely caught mid-write after all; the writer finishing is another change, which will try again
+            print('Hot reload of %s failed: %s' % (self.env.filename, error))
+            return None
+
+        env = self.env
+        self.from_pack = reload.from_pack
+        if reload.info is not None:
+            env.info = reload.info
+        if reload.geo is not None:
+            env.set_geo(reload.geo)
+        if reload.art is not None:
+            env.image = reload.art
+            env.dirty = 1
+        if reload.art_crc is not None:
+            self.art_crc = Future()
+            self.art_crc.set_result(reload.art_crc)
+
+        print('Reloaded %s' % ', '.join(part for part in ('info', 'geo', 'art')
+                                        if getattr(reload, part) is not None))
+        return env
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
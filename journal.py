@@ -0,0 +1,164 @@
+import os
+import struct
+
+
+# Journals: a header naming the level pack they apply on top of, then one record per edit.
+# Every record starts with its opcode, which says how long it is.
+_magic = b'MSGJ'
+_version = 1
+_header = struct.Struct('<4sHQQ')
+
+Add = 1
+Remove = 2
+Resize = 3
+Retype = 4
+
+# Add / Remove: geo id, surface type, rect (x, y, w, h)
+_geo = struct.Struct('<BIB4i')
+# Resize (which includes moving): geo id, old rect, new rect
+_resize = struct.Struct('<BI8i')
+# Retype: geo id, old surface type, new surface type
+_retype = struct.Struct('<BIBB')
+_records = {Add: _geo, Remove: _geo, Resize: _resize, Retype: _retype}
+
+
+def get_journal_filename(info):
+    return os.path.splitext(info)[0] + '.journal'
+
+
+def get_stamp(filename):
+    # Identifies the exact version of a file a journal was started on top of
+    if not os.path.exists(filename):
+        return 0, 0
+    stat = os.stat(filename)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def invert(command):
+    op, geo_id, a, b = command
+    if op == Add:
+        return Remove, geo_id, a, b
+    if op == Remove:
+        return Add, geo_id, a, b
+    # Resize and retype just swap old and new
+    return op, geo_id, b, a
+
+
+def pack(command):
+    op, geo_id, a, b = command
+    if op in (Add, Remove):
+        return _geo.pack(op, geo_id, a, *b)
+    if op == Resize:
+        return _resize.pack(op, geo_id, *a, *b)
+    return _retype.pack(op, geo_id, a, b)
+
+
+def unpack(data, offset):
+    # Returns the command at offset, or None if the journal ends part way through it
+    record = _records.get(data[offset])
+    if not record:
+        raise ValueError('Unknown journal record %d at %d' % (data[offset], offset))
+    if offset + record.size > len(data):
+        return None
+
+    values = record.unpack_from(data, offset)
+    op, geo_id = values[:2]
+    if op in (Add, Remove):
+        return op, geo_id, values[2], tuple(values[3:7])
+    if op == Resize:
+        return op, geo_id, tuple(values[2:6]), tuple(values[6:10])
+    return op, geo_id, values[2], values[3]
+
+
+class Journal(object):
+    """
+    An append-only log of editor commands, (op, geo id, old / type, new / rect) tuples.
+    Edits append a few bytes rather than rewriting the level; compacting saves the whole level and starts afresh.
+    Undo applies a command's inverse and redo reapplies it, one command per step.
+    """
+    def __init__(self, filename, stamp):
+        self.filename = filename
+        self.stamp = stamp
+        self.undo_stack = []
+        self.redo_stack = []
+        # Commands since the last compaction
+        self.count = 0
+        self.file = None
+
+    def open(self):
+        # Returns the commands an earlier session left for the current version of the level, then appends to them
+        commands = []
+        if os.path.exists(self.filename):
+            with open(self.filename, 'rb') as file:
+                data = file.read()
+            if len(data) >= _header.size:
+                magic, version, *stamp = _header.unpack_from(data)
+                if magic == _magic and version == _version and tuple(stamp) == tuple(self.stamp):
+                    offset = _header.size
+                    while offset < len(data):
+                        command = unpack(data, offset)
+                        if command is None:
+                            # A record cut short by a crash - drop it
+                            break
+                        commands.append(command)
+                        offset += _records[command[0]].size
+
+                    self.file = open(self.filename, 'r+b')
+                    self.file.truncate(offset)
+                    self.file.seek(offset)
+
+        if self.file is None:
+            # Missing, or for a different version of the level
+            self._start()
+
+        self.count = len(commands)
+        return commands
+
+    def _start(self):
+        if self.file:
+            self.file.close()
+        self.file = open(self.filename, 'wb')
+        self.file.write(_header.pack(_magic, _version, *self.stamp))
+        self.file.flush()
+
+    def record(self, command):
+        # For a command which has already been applied
+        self.file.write(pack(command))
+        self.count += 1
+        self.undo_stack.append(command)
+        self.redo_stack.clear()
+
+    def undo(self, apply):
+        if not self.undo_stack:
+            return None
+        command = self.undo_stack.pop()
+        self.redo_stack.append(command)
+        return self._replay(invert(command), apply)
+
+    def redo(self, apply):
+        if not self.redo_stack:
+            return None
+        command = self.redo_stack.pop()
+        self.undo_stack.append(command)
+        return self._replay(command, apply)
+
+    def _replay(self, command, apply):
+        # Undo and redo are edits too, so the log alone always reproduces the level
+        apply(command)
+        self.file.write(pack(command))
+        self.count += 1
+        return command
+
+    def flush(self):
+        self.file.flush()
+
+    def compact(self, stamp):
+        # The level has just been saved in full; nothing before this point needs replaying
+        self.stamp = stamp
+        self.count = 0
+        self._start()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
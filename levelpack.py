@@ -0,0 +1,136 @@
+from array import array
+import json
+import os
+import struct
+import sys
+import pygame
+import render
+
+
+# Layout: header, info JSON, surface type codes, rects (x, y, w, h) and the pre-scaled art.
+# Rects are always in design coordinates, whatever size the art was scaled to.
+_magic = b'MSGP'
+_version = 1
+_header = struct.Struct('<4sHHHIII')
+_art_format = 'RGB'
+
+
+class LevelPack(object):
+    def __init__(self, info, types, rects, art_size, art):
+        self.info = info
+        self.types = types
+        self.rects = rects
+        self.art_size = art_size
+        self.art = art
+
+    def get_art(self):
+        return pygame.image.frombuffer(self.art, self.art_size, _art_format)
+
+    def iter_geo(self):
+        rects = self.rects
+        for idx, surftype in enumerate(self.types):
+            yield surftype, rects[4 * idx:4 * idx + 4]
+
+
+def get_pack_filename(info, size=None):
+    # The level's own pack is at the design resolution; other resolutions cache their art beside it
+    return os.path.splitext(info)[0] + render.get_size_suffix(size) + '.pack'
+
+
+def is_stale(info, pack_filename):
+    # A pack is only trustworthy if nothing it was compiled from has changed since
+    pack_time = os.path.getmtime(pack_filename)
+    if os.path.getmtime(info) > pack_time:
+        return True
+
+    # Including, for another resolution's pack, the level's own pack, which the editor saves into
+    pack = get_pack_filename(info)
+    if pack != pack_filename and os.path.exists(pack) and os.path.getmtime(pack) > pack_time:
+        return True
+
+    with open(info, 'r') as file:
+        sources = json.load(file)
+
+    for key in ('art', 'geo'):
+        source = sources.get(key)
+        if source and os.path.exists(source) and os.path.getmtime(source) > pack_time:
+            return True
+
+    return False
+
+
+def load(filename) -> LevelPack:
+    # One bulk read - everything else is slicing
+    with open(filename, 'rb') as file:
+        data = memoryview(file.read())
+
+    magic, version, width, height, count, info_len, art_len = _header.unpack_from(data)
+    if magic != _magic or version != _version:
+        raise ValueError('%s is not a version %d level pack' % (filename, _version))
+
+    offset = _header.size
+    info = json.loads(bytes(data[offset:offset + info_len]))
+    offset += info_len
+    types = array('B', data[offset:offset + count])
+    offset += count
+    rects = array('i')
+    rects.frombytes(data[offset:offset + 16 * count])
+    if sys.byteorder != 'little':
+        rects.byteswap()
+    offset += 16 * count
+    art = data[offset:offset + art_len]
+    if len(art) != width * height * len(_art_format):
+        raise ValueError('%s is truncated' % filename)
+
+    return LevelPack(info, types, rects, (width, height), art)
+
+
+def save(filename, info, geo, art: pygame.Surface):
+    types = array('B', (int(surftype) for surftype, _ in geo))
+    rects = array('i')
+    for _, rect in geo:
+        rects.extend(rect)
+    if sys.byteorder != 'little':
+        rects.byteswap()
+
+    info_bytes = json.dumps(info).encode('utf-8')
+    art_bytes = pygame.image.tobytes(art, _art_format)
+    width, height = art.get_size()
+
+    # Write beside the target and swap in, so a reader never sees half a pack
+    temp = filename + '.tmp'
+    with open(temp, 'wb') as file:
+        file.write(_header.pack(_magic, _version, width, height, len(types), len(info_bytes), len(art_bytes)))
+        file.write(info_bytes)
+        file.write(types.tobytes())
+        file.write(rects.tobytes())
+        file.write(art_bytes)
+    os.replace(temp, filename)
+
+
+def compile_level(info, size=render.design_size):
+    # Imported here since the environment depends on this module for loading
+    from environment import load_legacy_geo
+
+    with open(info, 'r') as file:
+        level = json.load(file)
+
+    art = pygame.transform.scale(pygame.image.load(level['art']), size)
+    geo = [(geo.surftype.value, tuple(geo.rect)) for geo in load_legacy_geo(level['geo'])]
+    save(get_pack_filename(info, size), level, geo, art)
+
+
+def main(args):
+    # Usage: python levelpack.py [-s WIDTHxHEIGHT] assets/Basic.json ...
+    size = render.design_size
+    if len(args) > 1 and args[0] == '-s':
+        size = render.parse_size(args[1])
+        args = args[2:]
+
+    for info in args:
+        print('Compiling %s -> %s...' % (info, get_pack_filename(info, size)))
+        compile_level(info, size)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,103 @@
+from collections import OrderedDict
+
+
+class LoadCache(object):
+    """
+    Keeps recently used values resident, up to a budget in bytes, loading whatever's missing.
+    Keys can be prefetched on an executor, so a later `get` only has to adopt what was decoded in the background.
+    The least recently used go first; the newest value and any pinned keys are never evicted.
+    `on_evict` is handed each value as it's dropped, or on `clear`, e.g. to release what it holds open.
+    Only ever touched from one thread - the executor just runs the loads.
+    """
+    def __init__(self, load, get_size, budget, executor, on_evict=None):
+        self.load = load
+        self.get_size = get_size
+        self.on_evict = on_evict
+        self.budget = budget
+        self.executor = executor
+        self.used = 0
+        # Least recently used first
+        self.entries = OrderedDict()
+        self.pending = {}
+        # Keys which must stay resident, whatever the budget, e.g. what's on screen
+        self.pinned = set()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        self.poll()
+
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+            return value
+
+        # Either wait on an in-flight prefetch or load synchronously
+        future = self.pending.pop(key, None)
+        value = future.result() if future else self.load(key)
+        self._insert(key, value)
+        return value
+
+    def prefetch(self, keys):
+        self.poll()
+
+        for key in keys:
+            if key is not None and key not in self.entries and key not in self.pending:
+                self.pending[key] = self.executor.submit(self.load, key)
+
+    def wait(self, keys):
+        # Blocks until none of the keys are being prefetched any more
+        for key in keys:
+            future = self.pending.get(key)
+            if future:
+                future.exception()
+        self.poll()
+
+    def is_loading(self, key):
+        return key in self.pending
+
+    def poll(self):
+        # Adopt any prefetches which have finished in the background
+        for key, future in list(self.pending.items()):
+            if not future.done():
+                continue
+
+            del self.pending[key]
+            if future.exception():
+                # Leave it to a synchronous load to surface the error when it is actually needed
+                continue
+
+            self._insert(key, future.result())
+
+    def _insert(self, key, value):
+        if key in self.entries:
+            self._evict(key, value)
+
+        self.entries[key] = value
+        self.used += self.get_size(value)
+
+        for old in list(self.entries):
+            if self.used <= self.budget:
+                break
+            if old != key and old not in self.pinned:
+                self._evict(old)
+
+    def _evict(self, key, replacement=None):
+        value = self.entries.pop(key)
+        self.used -= self.get_size(value)
+        if self.on_evict and value is not replacement:
+            self.on_evict(value)
+
+    def clear(self):
+        values = list(self.entries.values())
+        # Prefetches which already finished are let go too; the rest are cancelled unless they've started
+        for future in self.pending.values():
+            if not future.cancel() and future.done() and not future.exception():
+                values.append(future.result())
+        self.entries.clear()
+        self.pending.clear()
+        self.used = 0
+        if self.on_evict:
+            for value in values:
+                self.on_evict(value)
@@ -4,15 +4,27 @@
 # ]
 # ///
 
+import argparse
 import asyncio
+import os
 import pygame
 import sys
+import time
+import actions
+import hotreload
+import netghost
+import playback
+import preload
+from profiler import profiler, ProfilerOverlay
 from skater import Skater
-from environment import Environment
+from textcache import ComboText
+import render
+import telemetry
+from debugdraw import debug, DebugOverlay
+from environment import EnvironmentCache
 
 
 is_dev_mode = True
-size = (width, height) = (960, 720)
 nothing = pygame.Color(0, 0, 0, 0)
 red = pygame.Color(255, 0, 0)
 green = pygame.Color(0, 255, 0)
@@ -21,6 +33,8 @@ blue = pygame.Color(0, 0, 255)
 
 class Config(object):
     def __init__(self):
+        # What the game renders at; the display stretches it to the window. Smaller is cheaper to fill
+        self.internal_size = render.design_size
         self.intro_name_times = (
             (500, 1000),
             (2000, 2500),
@@ -33,49 +47,227 @@ class Config(object):
             (6000, 6500),
             (8500, 9000),
         )
+        # Step the physics at a fixed rate, independent of the frame rate, and interpolate when drawing
+        self.fixed_timestep = True
+        self.physics_rate = 120
+        # Cap the steps per frame so a stall can't snowball into ever longer frames
+        self.max_substeps = 12
+        # Only push the parts of the screen which changed, rather than flipping every frame
+        self.dirty_rendering = True
+        # F2 toggles debug drawing (collisions, velocities)
+        self.debug_key = pygame.K_F2
+        # F3 toggles the profiler and its overlay, F4 writes what it has traced so far
+        self.profiler_key = pygame.K_F3
+        self.trace_key = pygame.K_F4
+        self.trace_filename = 'profile_trace.json'
+        # Watch the active level's files and swap in edits without restarting
+        self.hot_reload = is_dev_mode
+        # Ghost skaters simulated together in NumPy, sharing the player's scene; 0 disables them
+        self.crowd_size = 0
+        # Threads decoding levels while the intro plays
+        self.preload_workers = 4
+        # Keycode -> action; rebind through State.actions
+        self.bindings = dict(actions.default_bindings)
+        # Pooled sparks and dust; 0 disables them
+        self.particle_capacity = 1024
+        # Where every trick, landing, bail and scene change of every run is kept; None disables it
+        self.telemetry_filename = 'telemetry.db'
+        # 'host:port' of a netghost server, to race the other players connected to it as ghosts
+        self.ghost_server = None
 
 
 class State(object):
-    def __init__(self, clock: pygame.time.Clock, screen):
+    def __init__(self, clock: pygame.time.Clock, screen, level='assets/Basic.json', ghost_server=None):
         self.config = Config()
+        self.config.ghost_server = ghost_server or self.config.ghost_server
+        # For measuring how long it takes to get something on screen
+        self.create_time = time.perf_counter()
         self.clock = clock
         self.screen = screen
+        # Everything in the world - art, geo, sprites, speeds - is in pixels at the screen's resolution
+        self.size = screen.get_size()
+        self.scale = render.get_scale(self.size)
+        width = self.size[0]
         self.is_intro_completed = False
-        self.font = pygame.font.Font('freesansbold.ttf', 64)
+        # Where time and input come from - the live clock and keyboard, or a recording
+        self.timer = playback.SimulationClock()
+        self.keys = playback.KeyState()
+        self.actions = actions.ActionMap(self.config.bindings)
+        self.input = playback.LiveInput()
+        self.font = pygame.font.Font('freesansbold.ttf', round(64 * self.scale))
         self.bob = Skater('assets/Skata.json', self)
-        self.env = Environment('assets/Basic.json', size)
-        self.world = pygame.sprite.Group()
+        # Every level in the chain starts decoding now; the first is waited on when the game starts
+        self.level = level
+        self.environments = EnvironmentCache(self.size, workers=self.config.preload_workers)
+        self.preloader = preload.Preloader(self.environments, level)
+        self.env = None
+        self.first_frame_time = None
+        self.reloader = hotreload.HotReloader() if self.config.hot_reload else None
+        self.world = pygame.sprite.LayeredDirty()
+        self.renderer = render.Renderer(screen, self.config.dirty_rendering)
+        self.accumulator = 0
+        self.combo = ComboText(self.font, green, width - round(64 * self.scale))
         self.combo_string = ''
-        self.combo_surface = None
-        self.combo_rect = None
+        self.combo_tricks = []
+        self.telemetry = telemetry.Telemetry(self.config.telemetry_filename) if self.config.telemetry_filename else None
+        self.combo_sprite = pygame.sprite.DirtySprite()
+        self.combo_sprite.image = self.combo.surface
+        self.combo_sprite.rect = self.combo.surface.get_rect()
+        self.combo_sprite.rect.midtop = (width / 2, self.combo.line_height / 2)
+        self.profiler_overlay = ProfilerOverlay(profiler, pygame.font.SysFont('monospace', 12))
+        self.profiler_overlay.rect.topright = (width - 8, 8)
+        self.debug_overlay = DebugOverlay(debug, self.size)
+        self.crowd, self.crowd_sprites = None, []
+        self.particles = None
+        if self.config.particle_capacity:
+            try:
+                from particles import ParticleSystem
+            except ImportError:
+                # Particles need numpy; the game is fine without them
+                ParticleSystem = None
+            if ParticleSystem:
+                self.particles = ParticleSystem(self.size, self.config.particle_capacity, scale=self.scale)
+        self.ghosts, self.ghost_sprites = None, {}
+        if self.config.ghost_server:
+            host, port = self.config.ghost_server.rsplit(':', 1)
+            self.ghosts = netghost.GhostClient((host, int(port)))
+
+    def start(self):
+        # Once the intro's done: everything from here on needs the first level
+        self.env = self.environments.get(self.level)
+        if self.reloader:
+            self.reloader.watch(self.env)
+        if self.config.crowd_size:
+            # Only the crowd needs numpy, so only import it when there is one
+            from crowd import Crowd
+            self.crowd = Crowd(self.bob, self.env, self.config.crowd_size, self.bob.gravity)
+            for idx in range(self.crowd.count):
+                self.crowd.spawn(idx, (0, 0), ((0.1 + 0.4 * idx / self.crowd.count) * self.scale, 0))
+            self.crowd_sprites = self.crowd.make_sprites()
+
+        self.is_intro_completed = True
+        self.add_to_world()
 
     def update_combo(self, trick):
-        # Cannot reuse font surfaces - must destroy and recreate
-        if self.combo_surface:
-            self.world.remove(self.combo_surface)
-
+        self.combo_tricks.append(trick)
+        self.record(telemetry.Trick, trick)
         if self.combo_string:
             self.combo_string += ' + ' + trick
         else:
             self.combo_string = trick
 
-        self.combo_surface = self.font.render(self.combo_string, True, green)
-        self.combo_rect = self.combo_surface.get_rect()
-        self.combo_rect.center = (width / 2, self.combo_rect.height)
+        # Only the new trick is rendered - the rest of the line is composed from cached pieces
+        self.combo.add(trick)
+        self.combo_sprite.dirty = 1
+        if not self.combo_sprite.alive():
+            self.world.add(self.combo_sprite, layer=render.hud_layer)
 
     def end_combo(self):
+        if self.combo_tricks:
+            self.record(telemetry.Combo, value=telemetry.score_combo(self.combo_tricks))
+            self.combo_tricks = []
         self.combo_string = ''
+        self.combo.end()
+
+    def record(self, kind, trick=None, value=0):
+        if self.telemetry:
+            self.telemetry.record(self.timer.get_ticks(), kind, self.env.filename, trick, value)
 
     def update_environment(self, next=True):
         self.world.remove(self.env)
         self.world.remove(self.bob)
 
+        direction = 1 if next else -1
         next = self.env.get_next() if next else self.env.get_prev()
         if next:
-            self.env = Environment(next, size)
+            self.env = self.environments.get(next)
+            # Decode the neighbours while this scene is playing
+            self.environments.prefetch(self.env.get_next(), self.env.get_prev())
+        if self.crowd:
+            self.crowd.set_environment(self.env)
+        if self.reloader:
+            self.reloader.watch(self.env)
+        self.record(telemetry.Scene, value=direction)
+
+        self.add_to_world()
+        # The whole background changed - redraw everything
+        self.env.dirty = 1
+        self.renderer.invalidate()
+
+    def environment_reloaded(self):
+        # Keep the skater where it is, on the reloaded version of whatever it was riding, if that's still there
+        bob = self.bob
+        bob.surface = self._find_geo(bob.surface)
+        if not bob.surface:
+            bob.depart()
+        bob.current_ledge = self._find_geo(bob.current_ledge)
+
+        if self.crowd:
+            self.crowd.set_environment(self.env)
+        self.renderer.invalidate()
+
+    def _find_geo(self, old):
+        if not old:
+            return None
+        return next((geo for geo in self.env.geo if geo.rect == old.rect and geo.surftype == old.surftype), None)
+
+    def update_ghosts(self):
+        # Trade snapshots with the server, and show whichever ghosts are in this scene
+        now = self.timer.get_ticks()
+        self.ghosts.send(now, self.bob, self.env.filename)
+        self.ghosts.poll(now)
+
+        level = netghost.get_level_id(self.env.filename)
+        cx, cy = self.env.camera
+        for ghost_id in set(self.ghost_sprites) - set(self.ghosts.ghosts):
+            self.ghost_sprites.pop(ghost_id).kill()
+        for ghost_id, ghost in self.ghosts.ghosts.items():
+            sprite = self.ghost_sprites.get(ghost_id)
+            if not sprite:
+                sprite = self.ghost_sprites[ghost_id] = netghost.GhostSprite(self.bob)
+            sample = ghost.sample(now)
+            if sample and sample[4] == level:
+                (x, y), _, anim, frame, _ = sample
+                sprite.show((x * self.scale - cx, y * self.scale - cy), anim, frame)
+                if not sprite.alive():
+                    self.world.add(sprite, layer=render.sprite_layer)
+            else:
+                sprite.kill()
+
+    def toggle_debug(self):
+        debug.enable(not debug.is_enabled)
+        if debug.is_enabled:
+            self.world.add(self.debug_overlay, layer=render.overlay_layer)
+        else:
+            self.world.remove(self.debug_overlay)
 
-        self.world.add(self.env)
-        self.world.add(self.bob)
+    def toggle_profiler(self):
+        profiler.enable(not profiler.is_enabled)
+        profiler.is_tracing = profiler.is_enabled
+        if profiler.is_enabled:
+            self.world.add(self.profiler_overlay, layer=render.hud_layer)
+        else:
+            self.world.remove(self.profiler_overlay)
+
+    def close(self):
+        self.environments.close()
+        if self.reloader:
+            self.reloader.close()
+        if self.telemetry:
+            self.telemetry.close()
+        if self.ghosts:
+            report = self.ghosts.get_report(self.timer.get_ticks())
+            print('Ghosts: %.0f ms round trip, %.1f kbps out' % (report['rtt_ms'], report['kbps_out']))
+            for ghost_id, stats in sorted(report['ghosts'].items()):
+                print('  %d: %.1f kbps in, %.1f snapshots/s of %.1f bytes, %d lost, %.1f ms jitter, ~%.0f ms behind'
+                      % (ghost_id, stats['kbps_in'], stats['snapshots_per_second'], stats['bytes_per_snapshot'],
+                         stats['lost'], stats['jitter_ms'], stats['latency_ms']))
+            self.ghosts.close()
+
+    def add_to_world(self):
+        self.world.add(self.env, layer=render.background_layer)
+        self.world.add(self.bob, layer=render.sprite_layer)
+        self.world.add(*self.crowd_sprites, layer=render.sprite_layer)
 
 
 def blend(t, t0, t1):
@@ -84,12 +276,12 @@ def blend(t, t0, t1):
 
 def intro_tick(state):
     if is_dev_mode:
-        state.is_intro_completed = True
-        state.world.add(state.env)
-        state.world.add(state.bob)
+        state.start()
         return
 
-    time = pygame.time.get_ticks()
+    state.preloader.draw_progress(state.screen, green)
+
+    time = state.timer.get_ticks()
     (nfis, nfie), (nfos, nfoe) = state.config.intro_name_times
     (pfis, pfie), (pfos, pfoe) = state.config.intro_pres_times
     (tfis, tfie), (tfos, tfoe) = state.config.intro_tit_times
@@ -105,7 +297,7 @@ def intro_tick(state):
         color = nothing.lerp(red, alpha)
         text = state.font.render('Mike Slegeir', True, color)
         textRect = text.get_rect()
-        textRect.center = (width/2, height/2)
+        textRect.center = state.screen.get_rect().center
         state.screen.blit(text, textRect)
 
     if time < pfis:
@@ -117,7 +309,7 @@ def intro_tick(state):
         color = nothing.lerp(green, alpha)
         text = state.font.render('PRESENTS...', True, color)
         textRect = text.get_rect()
-        textRect.center = (width/2, height/2)
+        textRect.center = state.screen.get_rect().center
         state.screen.blit(text, textRect)
 
     if time < tfis:
@@ -129,47 +321,116 @@ def intro_tick(state):
         color = nothing.lerp(blue, alpha)
         text = state.font.render('G N A R   S K A T A !', True, color)
         textRect = text.get_rect()
-        textRect.center = (1280/2, 720/2)
+        textRect.center = state.screen.get_rect().center
         state.screen.blit(text, textRect)
     else:
-        state.is_intro_completed = True
-        state.world.add(state.env)
-        state.world.add(state.bob)
+        # Wait out any loading still going, rather than starting on whichever frame it happens to finish,
+        # so the game starts at the same point in game time however fast the disk is - and replays do too
+        state.preloader.wait()
+        state.start()
 
 
-def game_tick(state, dt):
-    sys.stdout.write('%.1f\r' % dt)
+def step_world(state, dt):
+    state.world.update(dt, state)
+    if state.crowd:
+        with profiler.scope('Crowd.update'):
+            state.crowd.update(dt)
+    if state.particles:
+        with profiler.scope('ParticleSystem.update'):
+            state.particles.update(dt)
 
-    for event in pygame.event.get():
-        if event.type == pygame.QUIT or \
-                (event.type == pygame.KEYDOWN and pygame.key.name(event.key) == 'escape'):
-            return False
-        else:
-            # Assuming the player handles all events for now
-            state.bob.handle(event)
 
-    state.screen.fill('black')
+def simulate(state, dt):
+    # Returns how far the simulation is between its last two steps, for interpolation
+    config = state.config
+    if not config.fixed_timestep:
+        step_world(state, dt)
+        return 1.0
 
-    if not state.is_intro_completed:
-        intro_tick(state)
-    else:
-        state.world.update(dt, state)
-        state.world.draw(state.screen)
+    step = 1000.0 / config.physics_rate
+    state.accumulator = min(state.accumulator + dt, step * config.max_substeps)
+    while state.accumulator >= step:
+        step_world(state, step)
+        state.accumulator -= step
+
+    return state.accumulator / step
 
-        if state.combo_surface:
-            state.screen.blit(state.combo_surface, state.combo_rect)
 
-    pygame.display.flip()
+def game_tick(state, dt):
+    profiler.begin_frame()
+    state.timer.advance(dt)
+    with profiler.scope('events'):
+        for event in state.input.get_events(dt):
+            if event.type == pygame.QUIT or \
+                    (event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE):
+                return False
+            elif event.type == pygame.KEYDOWN and event.key == state.config.debug_key:
+                state.toggle_debug()
+            elif event.type == pygame.KEYDOWN and event.key == state.config.profiler_key:
+                state.toggle_profiler()
+            elif event.type == pygame.KEYDOWN and event.key == state.config.trace_key:
+                profiler.export_trace(state.config.trace_filename)
+                print('Wrote %s' % state.config.trace_filename)
+            else:
+                # Assuming the player handles all events for now
+                state.keys.handle(event)
+                state.bob.handle(event)
+
+    if state.reloader and state.reloader.poll(dt):
+        state.environment_reloaded()
+    if state.telemetry:
+        state.telemetry.poll(state.timer.get_ticks())
 
+    if not state.is_intro_completed:
+        state.screen.fill('black')
+        intro_tick(state)
+        pygame.display.flip()
+    else:
+        with profiler.scope('world.update'):
+            alpha = simulate(state, dt)
+
+        # Scrolling levels keep the camera on the skater; everything else is drawn relative to it
+        state.env.follow(state.bob.rect, state.bob.velocity)
+        cx, cy = state.env.camera
+        if state.ghosts:
+            with profiler.scope('ghosts'):
+                state.update_ghosts()
+
+        # Draw the skater between its last two physics states
+        physics_position = state.bob.rect.topleft
+        x, y = state.bob.get_render_position(alpha)
+        state.bob.rect.topleft = (x - cx, y - cy)
+        if state.crowd:
+            state.crowd.update_sprites(state.crowd_sprites, alpha, state.env.camera)
+        if state.particles:
+            with profiler.scope('ParticleSystem.draw'):
+                state.particles.draw(state.world, render.overlay_layer, state.env.camera)
+        if debug.is_enabled:
+            state.debug_overlay.redraw(state.env.camera)
+        state.renderer.draw(state.world)
+        state.bob.rect.topleft = physics_position
+
+    if state.first_frame_time is None:
+        profiler.milestone('first frame', state.create_time)
+        state.first_frame_time = profiler.milestones['first frame']
+    if state.preloader.finish_time is None:
+        state.preloader.poll()
+
+    profiler.end_frame()
+    if profiler.is_enabled:
+        state.profiler_overlay.redraw()
     return True
 
 
-async def main():
+async def main(record=None, ghost_server=None, resolution=None):
     pygame.init()
-    screen = pygame.display.set_mode(size)
+    screen = render.set_mode(resolution or Config().internal_size)
     pygame.display.set_caption('Mike Slegeir\'s Gnar Skater')
     clock = pygame.time.Clock()
-    state = State(clock, screen)
+    state = State(clock, screen, ghost_server=ghost_server)
+    if record:
+        recorder = playback.Recorder(record, state.level)
+        state.input = playback.LiveInput(recorder)
 
     t, lt = 0, 0
     while game_tick(state, t - lt):
@@ -178,10 +439,54 @@ async def main():
         lt = t
         t = pygame.time.get_ticks()
 
+    if record:
+        recorder.close(state)
+    state.close()
     pygame.quit()
 
 
+def replay(filename, resolution=None):
+    # Re-run a recorded session headless, as fast as possible, and check it ends up where the original did
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    recording = playback.Recording(filename)
+
+    pygame.init()
+    # Only the resolution it was recorded at reproduces it
+    screen = render.set_mode(resolution or Config().internal_size, is_scaled=False)
+    state = State(pygame.time.Clock(), screen, recording.level)
+    state.input = playback.ReplayInput(recording)
+    # Levels changing under a replay would only make it diverge, and its runs aren't new ones
+    if state.reloader:
+        state.reloader.close()
+        state.reloader = None
+    if state.telemetry:
+        state.telemetry.close()
+        state.telemetry = None
+    while state.input.next_frame() and game_tick(state, state.input.dt):
+        pass
+
+    digest = playback.get_digest(state)
+    state.close()
+    pygame.quit()
+
+    print('Replayed %d frames of %s' % (len(recording.frames), filename))
+    if recording.digest is not None and digest != recording.digest:
+        print('Diverged: expected %s, got %s' % (recording.digest, digest))
+        return False
+
+    return True
+
+
 if __name__ == '__main__':
     import code
     #code.interact(local=locals())
-    asyncio.run(main())
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--record', help='Record the session\'s input and timing to a file')
+    parser.add_argument('--replay', help='Replay a recorded session headless')
+    parser.add_argument('--ghost-server', help='Race the other players on a netghost server, as host:port')
+    parser.add_argument('--resolution', type=render.parse_size,
+                        help='Render at WIDTHxHEIGHT, stretched to the window; 960x720 unless configured otherwise')
+    args = parser.parse_args()
+    if args.replay:
+        sys.exit(0 if replay(args.replay, args.resolution) else 1)
+    asyncio.run(main(args.record, args.ghost_server, args.resolution))
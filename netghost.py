@@ -0,0 +1,502 @@
+import argparse
+from collections import deque
+import select
+import socket
+import struct
+import threading
+import time
+import zlib
+import pygame
+
+
+# Packets: a byte aligned header, then for snapshots a bit packed body.
+# Snapshots are deltas against the last one the receiver acknowledged, so an idle skater costs a few bytes.
+Snapshot = 1
+Ack = 2
+Leave = 3
+
+_header = struct.Struct('<BBHH')
+_ack = struct.Struct('<BBH')
+_none = 0xFFFF
+_history = 64
+
+# Fixed point: positions in 1/16 px, velocities in 1/4096 px per ms
+_position_scale = 16
+_velocity_scale = 4096
+# Snapshot fields: x, y, vx, vy (deltas), animation id, frame, level (raw)
+_deltas = 4
+_raw_widths = (8, 8, 32)
+# A two bit size class picks how many bits a delta takes
+_delta_widths = (4, 8, 16, 32)
+_empty = (0, 0, 0, 0, 0, 0, 0)
+# What a truncated or garbled datagram can raise while it's taken apart
+_packet_errors = (struct.error, ValueError, IndexError)
+
+
+def get_level_id(filename):
+    return zlib.crc32(filename.encode('utf-8'))
+
+
+def get_kind(data):
+    # The kind of packet, or None if it's too short to be any packet
+    if not data:
+        return None
+    kind = data[0]
+    size = _header.size if kind == Snapshot else _ack.size if kind in (Ack, Leave) else None
+    return kind if size is not None and len(data) >= size else None
+
+
+def make_state(skater, level, scale=1.0):
+    # In design coordinates, so players at different resolutions see each other in the right place
+    position, velocity = skater.position / scale, skater.velocity / scale
+    return (round(position.x * _position_scale), round(position.y * _position_scale),
+            round(velocity.x * _velocity_scale), round(velocity.y * _velocity_scale),
+            skater.anim.id, skater.frame, get_level_id(level))
+
+
+def _is_newer(seq, than):
+    # Sequence numbers wrap, so newer means less than half the range ahead
+    return seq != than and (seq - than) & 0xFFFF < 0x8000
+
+
+class BitWriter(object):
+    def __init__(self):
+        self.value = 0
+        self.bits = 0
+
+    def write(self, value, width):
+        self.value |= (value & ((1 << width) - 1)) << self.bits
+        self.bits += width
+
+    def to_bytes(self):
+        return self.value.to_bytes((self.bits + 7) // 8, 'little')
+
+
+class BitReader(object):
+    def __init__(self, data):
+        self.value = int.from_bytes(data, 'little')
+        self.available = len(data) * 8
+
+    def read(self, width):
+        if width > self.available:
+            raise ValueError('Snapshot is truncated')
+        value = self.value & ((1 << width) - 1)
+        self.value >>= width
+        self.available -= width
+        return value
+
+
+def encode_state(writer, state, baseline, remote_time):
+    writer.write(int(remote_time), 32)
+    for field, (value, base) in enumerate(zip(state, baseline)):
+        changed = value != base
+        writer.write(changed, 1)
+        if not changed:
+            continue
+        if field < _deltas:
+            # Zigzag, so small steps either way stay small
+            delta = value - base
+            zigzag = (delta << 1) ^ (delta >> 63)
+            size = next(size for size, width in enumerate(_delta_widths) if zigzag < 1 << width)
+            writer.write(size, 2)
+            writer.write(zigzag, _delta_widths[size])
+        else:
+            writer.write(value, _raw_widths[field - _deltas])
+
+
+def decode_state(reader, baseline):
+    remote_time = reader.read(32)
+    state = []
+    for field, base in enumerate(baseline):
+        if not reader.read(1):
+            state.append(base)
+        elif field < _deltas:
+            zigzag = reader.read(_delta_widths[reader.read(2)])
+            state.append(base + ((zigzag >> 1) ^ -(zigzag & 1)))
+        else:
+            state.append(reader.read(_raw_widths[field - _deltas]))
+    return remote_time, tuple(state)
+
+
+class Outgoing(object):
+    # One stream of snapshots, remembering what was sent until the receiver acknowledges something newer
+    def __init__(self):
+        self.seq = 0
+        self.history = {}
+        self.sent_times = {}
+        self.acked = None
+        self.rtt = None
+
+    def encode(self, ghost, state, remote_time, now):
+        baseline = self.history.get(self.acked) if self.acked is not None else None
+        self.seq = (self.seq + 1) & 0xFFFF
+        self.history[self.seq] = state
+        self.sent_times[self.seq] = now
+        # Anything too old to be a baseline any more is forgotten
+        self.history.pop((self.seq - _history) & 0xFFFF, None)
+        self.sent_times.pop((self.seq - _history) & 0xFFFF, None)
+
+        writer = BitWriter()
+        encode_state(writer, state, baseline or _empty, remote_time)
+        return _header.pack(Snapshot, ghost, self.seq, self.acked if baseline else _none) + writer.to_bytes()
+
+    def ack(self, seq, now):
+        sent = self.sent_times.get(seq)
+        if sent is None:
+            return
+        sample = now - sent
+        self.rtt = sample if self.rtt is None else self.rtt + (sample - self.rtt) / 8
+        if self.acked is None or _is_newer(seq, self.acked):
+            self.acked = seq
+
+
+class Incoming(object):
+    # The other end of an Outgoing: keeps what arrived, so later deltas have their baselines
+    def __init__(self):
+        self.received = {}
+        self.latest = None
+        self.lost = 0
+
+    def decode(self, seq, baseline, body):
+        # Returns (remote time, state), or None for a packet which is stale or can't be decoded
+        if self.latest is not None and not _is_newer(seq, self.latest):
+            return None
+        base = _empty if baseline == _none else self.received.get(baseline)
+        if base is None:
+            self.lost += 1
+            return None
+
+        remote_time, state = decode_state(BitReader(body), base)
+        if self.latest is not None:
+            self.lost += ((seq - self.latest) & 0xFFFF) - 1
+        self.latest = seq
+        self.received[seq] = state
+        if len(self.received) > _history:
+            self.received = {old: value for old, value in self.received.items() if (seq - old) & 0xFFFF < _history}
+        return remote_time, state
+
+
+class JitterBuffer(object):
+    """
+    Holds a ghost's snapshots long enough to always have two to interpolate between.
+    Remote times are mapped onto ours by the fastest transit seen recently, and playback trails that
+    by a delay which grows with the jitter.
+    """
+    def __init__(self, delay=100):
+        self.delay = delay
+        self.snapshots = deque()
+        self.transits = deque(maxlen=64)
+        self.last_transit = None
+        self.jitter = 0.0
+
+    def push(self, remote_time, state, now):
+        transit = now - remote_time
+        self.transits.append(transit)
+        if self.last_transit is not None:
+            # RFC 3550's running estimate
+            self.jitter += (abs(transit - self.last_transit) - self.jitter) / 16
+        self.last_transit = transit
+
+        if self.snapshots and remote_time <= self.snapshots[-1][0]:
+            # Out of order; one this old adds nothing
+            return
+        self.snapshots.append((remote_time, state))
+
+    def get_delay(self):
+        return max(self.delay, 3 * self.jitter)
+
+    def sample(self, now):
+        # The ghost's state as of now, or None before anything has arrived
+        if not self.snapshots:
+            return None
+        playback = now - min(self.transits) - self.get_delay()
+
+        while len(self.snapshots) > 2 and self.snapshots[1][0] <= playback:
+            self.snapshots.popleft()
+        t0, a = self.snapshots[0]
+        t1, b = self.snapshots[1] if len(self.snapshots) > 1 else self.snapshots[0]
+        if playback <= t0 or t1 == t0:
+            return a
+        if playback >= t1:
+            return b
+
+        alpha = (playback - t0) / (t1 - t0)
+        if a[-1] != b[-1]:
+            # Changing scenes; there's nothing in between
+            return a if alpha < 0.5 else b
+        lerped = tuple(x + (y - x) * alpha for x, y in zip(a[:_deltas], b[:_deltas]))
+        return lerped + (a if alpha < 0.5 else b)[_deltas:]
+
+
+class Ghost(object):
+    # Another player, as seen by this one
+    def __init__(self, ghost_id, delay):
+        self.id = ghost_id
+        self.incoming = Incoming()
+        self.buffer = JitterBuffer(delay)
+        self.bytes = 0
+        self.snapshots = 0
+        self.first_time = None
+        self.last_time = None
+
+    def sample(self, now):
+        state = self.buffer.sample(now)
+        if state is None:
+            return None
+        x, y, vx, vy, anim, frame, level = state
+        return (x / _position_scale, y / _position_scale), (vx / _velocity_scale, vy / _velocity_scale), \
+            anim, frame, level
+
+
+class GhostClient(object):
+    """
+    Sends our skater to a ghost server and keeps the other players it relays.
+    Time is the game's own clock in ms, so everything here follows a replayed session too.
+    """
+    def __init__(self, address, send_interval=50, delay=100):
+        self.address = address
+        self.send_interval = send_interval
+        self.delay = delay
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.socket.connect(address)
+        self.outgoing = Outgoing()
+        self.ghosts = {}
+        self.last_send = None
+        self.bytes_sent = 0
+        # Datagrams which couldn't be read, and were ignored
+        self.dropped = 0
+        self.start_time = None
+
+    def send(self, now, skater, level):
+        if self.start_time is None:
+            self.start_time = now
+        if self.last_send is not None and now - self.last_send < self.send_interval:
+            return
+        self.last_send = now
+
+        packet = self.outgoing.encode(0, make_state(skater, level, skater.scale), now, now)
+        self.bytes_sent += len(packet)
+        self._send(packet)
+
+    def _send(self, packet):
+        try:
+            self.socket.send(packet)
+        except (BlockingIOError, ConnectionRefusedError):
+            # It's UDP - a dropped packet is just a lost one
+            pass
+
+    def poll(self, now):
+        while True:
+            try:
+                data = self.socket.recv(2048)
+            except (BlockingIOError, ConnectionRefusedError):
+                return
+            self._receive(data, now)
+
+    def _receive(self, data, now):
+        try:
+            self._handle(data, now)
+        except _packet_errors:
+            # Garbage or cut short; it's UDP, so that's just a lost packet
+            self.dropped += 1
+
+    def _handle(self, data, now):
+        kind = get_kind(data)
+        if kind is None:
+            raise ValueError('Unknown or truncated packet')
+        if kind == Snapshot:
+            _, ghost_id, seq, baseline = _header.unpack_from(data)
+            ghost = self.ghosts.get(ghost_id)
+            if not ghost:
+                ghost = self.ghosts[ghost_id] = Ghost(ghost_id, self.delay)
+                ghost.first_time = now
+            ghost.bytes += len(data)
+            ghost.last_time = now
+            decoded = ghost.incoming.decode(seq, baseline, data[_header.size:])
+            if decoded:
+                ghost.snapshots += 1
+                ghost.buffer.push(*decoded, now)
+                self._send(_ack.pack(Ack, ghost_id, seq))
+        elif kind == Ack:
+            _, _, seq = _ack.unpack_from(data)
+            self.outgoing.ack(seq, now)
+        elif kind == Leave:
+            _, ghost_id, _ = _ack.unpack_from(data)
+            self.ghosts.pop(ghost_id, None)
+
+    def get_report(self, now):
+        """
+        Per ghost: incoming bandwidth, snapshot rate and size, loss, jitter and the estimated latency
+        from the other player moving to it showing up here, i.e. a round trip plus the jitter buffer's delay.
+        """
+        rtt = self.outgoing.rtt or 0.0
+        report = {}
+        for ghost_id, ghost in self.ghosts.items():
+            seconds = max(now - ghost.first_time, 1) / 1000
+            report[ghost_id] = {
+                'kbps_in': ghost.bytes * 8 / 1000 / seconds,
+                'snapshots_per_second': ghost.snapshots / seconds,
+                'bytes_per_snapshot': ghost.bytes / max(ghost.snapshots, 1),
+                'lost': ghost.incoming.lost,
+                'jitter_ms': ghost.buffer.jitter,
+                'latency_ms': rtt + ghost.buffer.get_delay(),
+            }
+        seconds = max(now - (self.start_time or now), 1) / 1000
+        return {'rtt_ms': rtt, 'kbps_out': self.bytes_sent * 8 / 1000 / seconds, 'ghosts': report}
+
+    def close(self):
+        self._send(_ack.pack(Leave, 0, 0))
+        self.socket.close()
+
+
+class _Client(object):
+    # A player connected to the server
+    def __init__(self, ghost_id):
+        self.id = ghost_id
+        self.incoming = Incoming()
+        # Ghost id -> the stream of that ghost to this client
+        self.outgoing = {}
+        self.last_seen = 0
+
+
+class GhostServer(object):
+    """
+    Relays each player's snapshots to everyone else, re-encoded against what each of them has acknowledged.
+    Players are known by address and dropped after a few seconds of silence.
+    """
+    def __init__(self, address=('127.0.0.1', 0), timeout=5.0):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(address)
+        self.address = self.socket.getsockname()
+        self.timeout = timeout
+        self.clients = {}
+        self.next_id = 0
+        # Datagrams which couldn't be read, and were ignored
+        self.dropped = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        # Serve on a thread, e.g. for a loopback session in the same process
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, name='ghost-server', daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        self.running = True
+        while self.running:
+            readable, _, _ = select.select([self.socket], [], [], 0.1)
+            now = time.monotonic()
+            if readable:
+                try:
+                    data, address = self.socket.recvfrom(2048)
+                except OSError:
+                    continue
+                self._receive(data, address, now)
+            self._expire(now)
+
+    def _receive(self, data, address, now):
+        is_known = address in self.clients
+        try:
+            self._handle(data, address, now)
+        except _packet_errors:
+            # One bad datagram mustn't take the relay down with it, nor make its sender a player
+            self.dropped += 1
+            if not is_known:
+                self.clients.pop(address, None)
+
+    def _handle(self, data, address, now):
+        kind = get_kind(data)
+        if kind is None:
+            raise ValueError('Unknown or truncated packet')
+        client = self.clients.get(address)
+        if not client:
+            client = self.clients[address] = _Client(self.next_id)
+            self.next_id = (self.next_id + 1) & 0xFF
+        client.last_seen = now
+
+        if kind == Snapshot:
+            _, _, seq, baseline = _header.unpack_from(data)
+            decoded = client.incoming.decode(seq, baseline, data[_header.size:])
+            if not decoded:
+                return
+            self.socket.sendto(_ack.pack(Ack, client.id, seq), address)
+            remote_time, state = decoded
+            # Pass it on with the sender's own timestamp, which is what the receivers' jitter buffers follow
+            for other_address, other in self.clients.items():
+                if other is not client:
+                    stream = other.outgoing.setdefault(client.id, Outgoing())
+                    self.socket.sendto(stream.encode(client.id, state, remote_time, now * 1000), other_address)
+        elif kind == Ack:
+            _, ghost_id, seq = _ack.unpack_from(data)
+            stream = client.outgoing.get(ghost_id)
+            if stream:
+                stream.ack(seq, now * 1000)
+        elif kind == Leave:
+            self._drop(address)
+
+    def _expire(self, now):
+        for address, client in list(self.clients.items()):
+            if now - client.last_seen > self.timeout:
+                self._drop(address)
+
+    def _drop(self, address):
+        client = self.clients.pop(address)
+        for other_address, other in self.clients.items():
+            other.outgoing.pop(client.id, None)
+            self.socket.sendto(_ack.pack(Leave, client.id, 0), other_address)
+
+    def close(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+        self.socket.close()
+
+
+class GhostSprite(pygame.sprite.DirtySprite):
+    # Draws a ghost with the local skater's frames, faded
+    def __init__(self, sheet, alpha=128):
+        super().__init__()
+        self.sheet = sheet
+        self.alpha = alpha
+        self.dirty = 2
+        self.images = {}
+        self.image = self._get_image(sheet.anim.id, 0)
+        self.rect = self.image.get_rect()
+
+    def _get_image(self, anim, frame):
+        key = (anim, frame)
+        image = self.images.get(key)
+        if image is None:
+            # The frames are shared with the skater, so fade a copy
+            image = self.images[key] = self.sheet.animations[anim].frames[frame].image.copy()
+            image.set_alpha(self.alpha)
+        return image
+
+    def show(self, position, anim, frame):
+        anims = self.sheet.animations
+        anim = anim if anim < len(anims) else 0
+        self.image = self._get_image(anim, min(frame, len(anims[anim].frames) - 1))
+        self.rect.topleft = round(position[0]), round(position[1])
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Relay ghost skaters between players')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=4555)
+    args = parser.parse_args(args)
+
+    server = GhostServer((args.host, args.port))
+    print('Serving ghosts on %s:%d' % server.address)
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if __name__ == '__main__':
+    import sys
+    main(sys.argv[1:])
@@ -0,0 +1,130 @@
+import numpy as np
+import pygame
+
+
+class Emitter(object):
+    # How one kind of effect sprays: a cone of directions, speeds, lifetimes and how much gravity pulls on it
+    def __init__(self, color, direction, spread, speed, lifetime, gravity=1.0, size=2, inherit=0.0):
+        self.color = pygame.Color(color)
+        # Radians, with y down, so -pi/2 is straight up
+        self.direction = direction
+        self.spread = spread
+        self.speed = speed
+        self.lifetime = lifetime
+        self.gravity = gravity
+        self.size = size
+        # How much of the skater's own velocity the particles carry
+        self.inherit = inherit
+
+
+emitters = {
+    'dust': Emitter((170, 150, 120), -np.pi / 2, np.pi / 2.5, (0.02, 0.12), (250, 500), gravity=0.3, size=3),
+    'sparks': Emitter((255, 200, 60), -np.pi / 2, np.pi / 3, (0.1, 0.35), (120, 300), size=2, inherit=0.5),
+    'debris': Emitter((200, 60, 40), -np.pi / 2, np.pi / 1.5, (0.05, 0.3), (300, 700), size=3, inherit=0.3),
+}
+
+
+class ParticleSystem(object):
+    """
+    Every particle lives in a slot of fixed size NumPy arrays, and all of them are moved together.
+    Slots are handed out round robin, so when the pool is full a new particle replaces the oldest one.
+    They're drawn with a single blits call onto one sprite, covering only where particles are.
+    """
+    def __init__(self, size, capacity=1024, gravity=0.0025, fade_steps=4, seed=0, scale=1.0):
+        self.capacity = capacity
+        # Emitter speeds are in design pixels; gravity and speeds scale with the resolution
+        self.scale = scale
+        self.gravity = gravity * scale
+        self.position = np.zeros((capacity, 2))
+        self.velocity = np.zeros((capacity, 2))
+        self.age = np.zeros(capacity)
+        # Nothing's alive until it's been emitted
+        self.lifetime = np.zeros(capacity)
+        self.weight = np.zeros(capacity)
+        self.kind = np.zeros(capacity, dtype=np.int64)
+        self.cursor = 0
+        # Live particles replaced before their time, for tuning the capacity
+        self.overflowed = 0
+        self.rng = np.random.default_rng(seed)
+
+        self.kinds = list(emitters)
+        self.fade_steps = fade_steps
+        # Kind -> fade step -> image, faded out as the particle ages
+        self.images = [[self._bake(emitters[kind], 1 - step / fade_steps) for step in range(fade_steps)]
+                       for kind in self.kinds]
+
+        # One screen sized layer, only ever cleared and drawn where the particles are
+        self.sprite = pygame.sprite.DirtySprite()
+        self.sprite.image = pygame.Surface(size, pygame.SRCALPHA)
+        self.sprite.rect = pygame.Rect(0, 0, 0, 0)
+        self.sprite.source_rect = pygame.Rect(0, 0, 0, 0)
+
+    @staticmethod
+    def _bake(emitter, alpha):
+        image = pygame.Surface((emitter.size, emitter.size), pygame.SRCALPHA)
+        color = pygame.Color(emitter.color)
+        color.a = round(255 * alpha)
+        image.fill(color)
+        return image
+
+    def get_live_count(self):
+        return int(np.count_nonzero(self.age < self.lifetime))
+
+    def emit(self, kind, position, count, velocity=(0, 0)):
+        emitter = emitters[kind]
+        count = min(count, self.capacity)
+        if count <= 0:
+            return
+
+        slots = (self.cursor + np.arange(count)) % self.capacity
+        self.cursor = (self.cursor + count) % self.capacity
+        self.overflowed += int(np.count_nonzero(self.age[slots] < self.lifetime[slots]))
+
+        rng = self.rng
+        angle = emitter.direction + rng.uniform(-emitter.spread, emitter.spread, count)
+        speed = rng.uniform(*emitter.speed, count) * self.scale
+        self.position[slots] = position
+        self.velocity[slots, 0] = np.cos(angle) * speed + velocity[0] * emitter.inherit
+        self.velocity[slots, 1] = np.sin(angle) * speed + velocity[1] * emitter.inherit
+        self.age[slots] = 0
+        self.lifetime[slots] = rng.uniform(*emitter.lifetime, count)
+        self.weight[slots] = emitter.gravity
+        self.kind[slots] = self.kinds.index(kind)
+
+    def update(self, dt):
+        live = self.age < self.lifetime
+        self.velocity[:, 1] += np.where(live, self.gravity * self.weight * dt, 0)
+        self.position += self.velocity * dt
+        self.age += dt
+
+    def draw(self, world, layer, camera=(0, 0)):
+        sprite = self.sprite
+        image = sprite.image
+        image.fill((0, 0, 0, 0), sprite.source_rect)
+
+        live = np.nonzero(self.age < self.lifetime)[0]
+        position = np.round(self.position[live] - camera).astype(np.int64)
+        width, height = image.get_size()
+        on_screen = (position[:, 0] >= 0) & (position[:, 0] < width) & (position[:, 1] >= 0) & (position[:, 1] < height)
+        live, position = live[on_screen], position[on_screen]
+        if not len(live):
+            if sprite.alive():
+                # Leaving the world repaints where it last was
+                sprite.kill()
+            return
+
+        steps = np.minimum((self.age[live] / self.lifetime[live] * self.fade_steps).astype(np.int64),
+                           self.fade_steps - 1)
+        images = self.images
+        image.blits([(images[kind][step], (x, y)) for kind, step, (x, y)
+                     in zip(self.kind[live].tolist(), steps.tolist(), position.tolist())], doreturn=False)
+
+        # Just the area the particles cover, with room for the largest of them
+        left, top = position.min(axis=0).tolist()
+        right, bottom = (position.max(axis=0) + max(emitter.size for emitter in emitters.values())).tolist()
+        bounds = pygame.Rect(left, top, right - left, bottom - top).clip(image.get_rect())
+        sprite.rect = bounds.copy()
+        sprite.source_rect = bounds
+        sprite.dirty = 1
+        if not sprite.alive():
+            world.add(sprite, layer=layer)
@@ -0,0 +1,138 @@
+import struct
+import pygame
+
+
+class SimulationClock(object):
+    """
+    Game time, advanced by each frame's dt rather than read from the wall clock,
+    so that a replayed session sees exactly the times the live one did.
+    """
+    def __init__(self):
+        self.ticks = 0
+
+    def get_ticks(self):
+        return self.ticks
+
+    def advance(self, dt):
+        self.ticks += dt
+
+
+class KeyState(object):
+    # Which keys are held, tracked from the events the game handled rather than from pygame's global state
+    def __init__(self):
+        self.pressed = set()
+
+    def handle(self, event):
+        if event.type == pygame.KEYDOWN:
+            self.pressed.add(event.key)
+        elif event.type == pygame.KEYUP:
+            self.pressed.discard(event.key)
+
+    def is_pressed(self, key):
+        return key in self.pressed
+
+
+# Recordings: a header, then a frame record per frame and an end record holding a digest of the final state
+_magic = b'MSGR'
+_version = 1
+_header = struct.Struct('<4sHH')
+_frame = struct.Struct('<cdH')
+_event = struct.Struct('<BiH')
+_end = struct.Struct('<cddddH')
+
+# Only the events the game acts on are recorded
+_event_types = (pygame.KEYDOWN, pygame.KEYUP, pygame.QUIT)
+_event_codes = {event_type: code for code, event_type in enumerate(_event_types)}
+
+
+def get_digest(state):
+    bob = state.bob
+    return bob.position.x, bob.position.y, bob.velocity.x, bob.velocity.y, state.env.filename
+
+
+class Recorder(object):
+    def __init__(self, filename, level):
+        self.file = open(filename, 'wb')
+        level = level.encode('utf-8')
+        self.file.write(_header.pack(_magic, _version, len(level)))
+        self.file.write(level)
+
+    def record(self, dt, events):
+        events = [event for event in events if event.type in _event_codes]
+        self.file.write(_frame.pack(b'F', dt, len(events)))
+        for event in events:
+            self.file.write(_event.pack(_event_codes[event.type], getattr(event, 'key', 0), getattr(event, 'mod', 0)))
+
+    def close(self, state):
+        *values, filename = get_digest(state)
+        filename = filename.encode('utf-8')
+        self.file.write(_end.pack(b'E', *values, len(filename)))
+        self.file.write(filename)
+        self.file.close()
+
+
+class Recording(object):
+    def __init__(self, filename):
+        with open(filename, 'rb') as file:
+            data = file.read()
+
+        magic, version, level_len = _header.unpack_from(data)
+        if magic != _magic or version != _version:
+            raise ValueError('%s is not a version %d recording' % (filename, _version))
+
+        offset = _header.size
+        self.level = data[offset:offset + level_len].decode('utf-8')
+        offset += level_len
+
+        # [(dt, [event, ...]), ...]
+        self.frames = []
+        self.digest = None
+        while offset < len(data):
+            tag = data[offset:offset + 1]
+            if tag == b'F':
+                _, dt, count = _frame.unpack_from(data, offset)
+                offset += _frame.size
+                events = []
+                for _ in range(count):
+                    code, key, mod = _event.unpack_from(data, offset)
+                    offset += _event.size
+                    events.append(pygame.event.Event(_event_types[code], key=key, mod=mod))
+                self.frames.append((dt, events))
+            elif tag == b'E':
+                _, x, y, vx, vy, filename_len = _end.unpack_from(data, offset)
+                offset += _end.size
+                self.digest = (x, y, vx, vy, data[offset:offset + filename_len].decode('utf-8'))
+                offset += filename_len
+            else:
+                raise ValueError('%s is corrupt at byte %d' % (filename, offset))
+
+
+class LiveInput(object):
+    # Events from pygame, optionally recorded as they're handed to the game
+    def __init__(self, recorder: Recorder = None):
+        self.recorder = recorder
+
+    def get_events(self, dt):
+        events = pygame.event.get()
+        if self.recorder:
+            self.recorder.record(dt, events)
+        return events
+
+
+class ReplayInput(object):
+    # Events from a recording, a frame at a time; the driver steps the game with each frame's dt
+    def __init__(self, recording: Recording):
+        self.frames = iter(recording.frames)
+        self.dt = 0
+        self.events = []
+
+    def next_frame(self):
+        frame = next(self.frames, None)
+        if frame is None:
+            return False
+
+        self.dt, self.events = frame
+        return True
+
+    def get_events(self, dt):
+        return self.events
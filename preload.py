@@ -0,0 +1,66 @@
+import json
+import time
+import pygame
+from environment import EnvironmentCache
+from profiler import profiler
+
+
+def walk_chain(level):
+    # Every level reachable through next / prev, starting from the given one
+    seen, pending = [], [level]
+    while pending:
+        filename = pending.pop()
+        if filename in seen:
+            continue
+        seen.append(filename)
+        with open(filename) as file:
+            info = json.load(file)
+        pending.extend(info[key] for key in ('next', 'prev') if info.get(key))
+    return seen
+
+
+class Preloader(object):
+    """
+    Decodes every level reachable from the first into an environment cache, on the cache's worker pool,
+    so that the intro hides the loading and no scene change has to wait on the disk.
+    Only the manifests are read up front; they're a few bytes each.
+    """
+    def __init__(self, environments: EnvironmentCache, level):
+        self.environments = environments
+        self.start_time = time.perf_counter()
+        self.finish_time = None
+        # The first level is queued first, so it's ready soonest
+        self.filenames = walk_chain(level)
+        environments.prefetch(*self.filenames)
+
+    def poll(self):
+        # Returns the fraction of levels decoded so far
+        if self.finish_time is not None:
+            return 1.0
+
+        self.environments.poll()
+        loading = sum(1 for filename in self.filenames if self.environments.is_loading(filename))
+        if not loading:
+            self.finish_time = time.perf_counter()
+            profiler.milestone('preload', self.start_time, self.finish_time)
+        return 1.0 - loading / len(self.filenames)
+
+    def is_done(self):
+        return self.poll() == 1.0
+
+    def wait(self):
+        # Blocks until every level's decoded
+        self.environments.wait(*self.filenames)
+        self.poll()
+
+    def get_elapsed(self):
+        # Milliseconds spent preloading, so far or in all
+        end = self.finish_time if self.finish_time is not None else time.perf_counter()
+        return (end - self.start_time) * 1000
+
+    def draw_progress(self, screen: pygame.Surface, color):
+        # A thin bar along the bottom of the screen, gone once everything's loaded
+        progress = self.poll()
+        if progress < 1.0:
+            rect = screen.get_rect()
+            pygame.draw.rect(screen, color, (0, rect.height - 4, round(rect.width * progress), 4))
@@ -0,0 +1,182 @@
+from collections import deque
+import json
+import time
+import pygame
+
+
+class _NullScope(object):
+    # Handed out while profiling is off, so a scope costs a method call and nothing else
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_null_scope = _NullScope()
+
+
+class Scope(object):
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.profiler.record(self.name, self.start, time.perf_counter())
+        return False
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+class Profiler(object):
+    """
+    Named timing scopes, summed per frame into rolling histories.
+    Optionally keeps every scope as a trace event, for export to a trace viewer (chrome://tracing, Perfetto).
+    """
+    def __init__(self, history=600, trace_capacity=200000):
+        self.is_enabled = False
+        self.is_tracing = False
+        self.history = history
+        self.scopes = {}
+        # name -> deque of per-frame totals, in milliseconds
+        self.samples = {}
+        self.frame_times = deque(maxlen=history)
+        self.frame_totals = {}
+        self.frame_start = 0
+        self.trace = deque(maxlen=trace_capacity)
+        self.epoch = time.perf_counter()
+        # One-off timings, like startup, in milliseconds; kept (and traced) whether or not profiling is on
+        self.milestones = {}
+
+    def enable(self, is_enabled=True):
+        self.is_enabled = is_enabled
+        self.frame_totals.clear()
+        # We may be switched on part way through a frame
+        self.frame_start = time.perf_counter()
+
+    def scope(self, name):
+        if not self.is_enabled:
+            return _null_scope
+
+        scope = self.scopes.get(name)
+        if not scope:
+            scope = self.scopes[name] = Scope(self, name)
+        return scope
+
+    def record(self, name, start, end):
+        self.frame_totals[name] = self.frame_totals.get(name, 0.0) + (end - start) * 1000
+        if self.is_tracing:
+            self.trace.append((name, start, end))
+
+    def milestone(self, name, start, end=None):
+        end = time.perf_counter() if end is None else end
+        self.milestones[name] = (end - start) * 1000
+        self.trace.append((name, start, end))
+
+    def begin_frame(self):
+        if self.is_enabled:
+            self.frame_start = time.perf_counter()
+
+    def end_frame(self):
+        if not self.is_enabled:
+            return
+
+        end = time.perf_counter()
+        self.frame_times.append((end - self.frame_start) * 1000)
+        if self.is_tracing:
+            self.trace.append(('frame', self.frame_start, end))
+
+        # Scopes which didn't run this frame still get a sample, so the histories line up
+        for name in self.scopes:
+            samples = self.samples.get(name)
+            if samples is None:
+                samples = self.samples[name] = deque(maxlen=self.history)
+            samples.append(self.frame_totals.get(name, 0.0))
+        self.frame_totals.clear()
+
+    def get_stats(self, name='frame'):
+        samples = self.frame_times if name == 'frame' else self.samples.get(name, ())
+        return {
+            'p50': percentile(samples, 0.50),
+            'p95': percentile(samples, 0.95),
+            'p99': percentile(samples, 0.99),
+            'worst': max(samples, default=0.0),
+        }
+
+    def export_trace(self, filename):
+        # Chrome trace event format - complete events, in microseconds
+        events = [{
+            'name': name,
+            'ph': 'X',
+            'ts': (start - self.epoch) * 1e6,
+            'dur': (end - start) * 1e6,
+            'pid': 0,
+            'tid': 0,
+        } for name, start, end in self.trace]
+        with open(filename, 'w') as file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
+
+
+profiler = Profiler()
+
+
+class ProfilerOverlay(pygame.sprite.DirtySprite):
+    """
+    A graph of recent frame times, with the percentiles of each scope listed beneath it.
+    """
+    def __init__(self, profiler: Profiler, font: pygame.font.Font, size=(360, 200), budget=1000 / 60):
+        super().__init__()
+        self.profiler = profiler
+        self.font = font
+        self.budget = budget
+        self.image = pygame.Surface(size, pygame.SRCALPHA)
+        self.rect = self.image.get_rect()
+        self.graph_height = size[1] // 2
+
+    def redraw(self):
+        # Once per frame, rather than on every world update
+        image = self.image
+        width = image.get_width()
+        image.fill((0, 0, 0, 160))
+
+        # One bar per frame, scaled so the frame budget sits halfway up the graph
+        scale = self.graph_height / (2 * self.budget)
+        frames = list(self.profiler.frame_times)[-width:]
+        x = width - len(frames)
+        for ms in frames:
+            height = min(int(ms * scale), self.graph_height)
+            color = (0, 255, 0) if ms <= self.budget else (255, 0, 0)
+            image.fill(color, (x, self.graph_height - height, 1, height))
+            x += 1
+        image.fill((255, 255, 255), (0, self.graph_height // 2, width, 1))
+
+        y = self.graph_height + 2
+        for name in ['frame'] + list(self.profiler.scopes):
+            stats = self.profiler.get_stats(name)
+            text = '%-20s %5.2f %5.2f %5.2f %6.2f' % (name[-20:], stats['p50'], stats['p95'], stats['p99'], stats['worst'])
+            image.blit(self.font.render(text, True, (255, 255, 255)), (2, y))
+            y += self.font.get_linesize()
+            if y >= image.get_height():
+                break
+
+        for name, ms in self.profiler.milestones.items():
+            if y >= image.get_height():
+                break
+            image.blit(self.font.render('%-20s %8.0f ms' % (name[-20:], ms), True, (255, 255, 255)), (2, y))
+            y += self.font.get_linesize()
+
+        self.dirty = 1
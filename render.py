@@ -0,0 +1,98 @@
+import argparse
+import pygame
+from profiler import profiler
+
+
+# Draw order within the world
+background_layer = 0
+sprite_layer = 1
+overlay_layer = 2
+hud_layer = 3
+
+# Levels and sprites are authored at this resolution. The game can render smaller (or larger), and the display
+# stretches whatever it renders to fit the window.
+design_size = (960, 720)
+
+
+def get_scale(size):
+    # How many internal pixels to a design pixel; check_size keeps both axes scaling alike
+    return size[0] / design_size[0]
+
+
+def check_size(size):
+    # Art is stretched to the whole screen but geo and speeds take a single scale, so only the design's shape works
+    width, height = size
+    if width <= 0 or height <= 0 or width * design_size[1] != height * design_size[0]:
+        raise ValueError('Resolution %dx%d must keep the shape of %dx%d (4:3), e.g. 640x480 or 1280x960'
+                         % (width, height, design_size[0], design_size[1]))
+
+
+def get_size_suffix(size):
+    # Files cached per resolution are told apart by this; the design resolution's keep their plain names
+    if size is None or tuple(size) == design_size:
+        return ''
+    return '.%dx%d' % tuple(size)
+
+
+def parse_size(text):
+    # 'WIDTHxHEIGHT', for argparse
+    try:
+        size = tuple(int(v) for v in text.lower().split('x'))
+    except ValueError:
+        size = ()
+    if len(size) != 2:
+        raise argparse.ArgumentTypeError('Resolution %r should be WIDTHxHEIGHT' % text)
+    try:
+        check_size(size)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+    return size
+
+
+def set_mode(size, is_scaled=True):
+    # The display surface is the internal resolution; SCALED leaves SDL to stretch it to the window
+    check_size(size)
+    return pygame.display.set_mode(size, pygame.SCALED | pygame.RESIZABLE if is_scaled else 0)
+
+
+class Renderer(object):
+    """
+    Draws a LayeredDirty world, pushing only the rects which changed to the display.
+    Anything which invalidates the whole screen (e.g. a scene transition) should call `invalidate`,
+    and the next frame falls back to a full redraw and flip.
+    """
+    def __init__(self, screen: pygame.Surface, is_dirty_enabled=True):
+        self.screen = screen
+        self.screen_rect = screen.get_rect()
+        self.is_dirty_enabled = is_dirty_enabled
+        self.is_invalid = True
+        # Per frame, and in total, for comparing rendering modes
+        self.pixels_pushed = 0
+        self.total_pixels_pushed = 0
+        self.frames = 0
+
+    def invalidate(self):
+        self.is_invalid = True
+
+    def draw(self, world: pygame.sprite.LayeredDirty):
+        is_full = self.is_invalid or not self.is_dirty_enabled
+        if is_full:
+            world.repaint_rect(self.screen_rect)
+            self.is_invalid = False
+
+        with profiler.scope('world.draw'):
+            rects = world.draw(self.screen)
+
+        with profiler.scope('display.flip'):
+            if is_full:
+                pygame.display.flip()
+                self.pixels_pushed = self.screen_rect.width * self.screen_rect.height
+            else:
+                pygame.display.update(rects)
+                self.pixels_pushed = sum(rect.width * rect.height for rect in rects)
+
+        self.total_pixels_pushed += self.pixels_pushed
+        self.frames += 1
+
+    def get_average_pixels_pushed(self):
+        return self.total_pixels_pushed / self.frames if self.frames else 0
@@ -1,49 +1,64 @@
 import pygame
 
 import environment
+import telemetry
+from actions import Action, InputBuffer, directions
+from debugdraw import debug
+from profiler import profiler
 from spritesheet import SpriteSheet
 
 
 class Skater(SpriteSheet):
     def __init__(self, info, state):
-        super().__init__(info)
+        # Speeds are in pixels, so they scale with the resolution along with everything else
+        self.scale = state.scale if state else 1.0
+        super().__init__(info, self.scale)
         self.state = state
         self.velocity = pygame.math.Vector2()
-        self.gravity = 0.0025
+        # Sub-pixel position; the rect is the rounded copy used for drawing and collision
+        self.position = pygame.math.Vector2(self.rect.topleft)
+        self.last_position = self.position.copy()
+        self.gravity = 0.0025 * self.scale
         self.input_look_back = 60
         self.input_look_ahead = 120
         self.depart()
-        self.last_dir = None
-        self.last_dir_time = -1
+        # Recent actions, for look-back; look-ahead waits on a latent action instead
+        self.inputs = InputBuffer()
         self.latent_action = None
         self.latent_action_deadline = -1
         self.current_ledge = None
-        self.grind_deadline = -1
 
-        self.debug_overlay = pygame.sprite.Sprite()
-        self.debug_overlay.image = pygame.surface.Surface(self.image.get_size()).convert_alpha()
-        pygame.draw.circle(self.debug_overlay.image, (255, 0, 0), (4, 4), 4)
-        self.debug_overlay.rect = self.debug_overlay.image.get_rect()
+        # The skater moves nearly every step, so always redraw it
+        self.dirty = 2
 
     def update(self, dt, *args, **kwargs):
-        ox, oy = self.rect.topleft
-        self.debug_overlay.image.fill((0, 0, 0, 0))
+        with profiler.scope('Skater.update'):
+            self._update(dt)
 
-        # Apply gravity
+    def _update(self, dt):
+        # Apply gravity, which only pulls along the ground where it slopes
         if not self.is_grounded:
             self.velocity.y += self.gravity * dt
-
-        # Draw debug lines
-        center = pygame.math.Vector2(self.rect.size)/2
-        pygame.draw.line(self.debug_overlay.image, (0, 0, 255), center, center + self.velocity * dt)
-
-        # Move according to the velocity
-        self.rect.move_ip(*(self.velocity * dt))
-        self.debug_overlay.rect = self.rect
+        else:
+            slope = self.state.env.get_ground_slope(self.rect.centerx, self.surface)
+            if slope:
+                self.velocity.x += self.gravity * dt * slope / (1 + slope * slope)
+
+        if debug.is_enabled:
+            center = pygame.math.Vector2(self.rect.center)
+            debug.line((0, 0, 255), center, center + self.velocity * dt)
+
+        # Move according to the velocity, remembering where we started for sweeping and interpolation
+        self.last_position.update(self.position)
+        start = pygame.math.Vector2(self.rect.midbottom)
+        start.y -= 1
+        self.position += self.velocity * dt
+        self.rect.topleft = round(self.position.x), round(self.position.y)
+        end = pygame.math.Vector2(self.rect.midbottom)
+        end.y -= 1
 
         # Detect the character moving off the screen
-        ew, eh = self.state.env.rect.size
-        # FIXME: Use a screen rect
+        ew, eh = self.state.env.bounds.size
         if self.rect.x > ew or self.rect.y > eh or self.rect.x < -self.rect.width:
             # Move to the next scene, if appropriate
             if self.rect.x > ew:
@@ -52,17 +67,34 @@ class Skater(SpriteSheet):
                 self.state.update_environment(next=False)
 
             self.rect.topleft = (0, 0)
-            self.velocity.x = min(max(self.velocity.x, -10), 10)
+            self.position.update(0, 0)
+            self.last_position.update(0, 0)
+            self.velocity.x = min(max(self.velocity.x, -10 * self.scale), 10 * self.scale)
             self.velocity.y = 0
             self.animate('float')
             return
 
         # Environmental collision detection
-        collision = self.state.env.get_surface_at(self.rect)
+        # Sweep the bottom of the sprite along its path first, so a long step can't tunnel through thin geo
+        collision = None
+        if not self.is_grounded and start != end:
+            collision, point = self.state.env.get_surface_along(start, end)
+            if collision:
+                if self.reaches_ground(collision, point[0], point[1] + 1):
+                    # Back up to where the bottom of the sprite first touched it
+                    self.move_to((point[0], point[1] + 1))
+                elif not self.reaches_ground(collision, self.rect.centerx, self.rect.bottom):
+                    collision = None
+        if not collision:
+            collision = self.state.env.get_surface_at(self.rect)
+            if collision and not self.is_grounded and \
+                    not self.reaches_ground(collision, self.rect.centerx, self.rect.bottom):
+                collision = None
+
         if collision:
-            center = pygame.math.Vector2(collision.rect.center)
-            pygame.draw.circle(self.debug_overlay.image, (255, 0, 0), center - self.rect.topleft, 4)
-            self.state.world.add(self.debug_overlay)
+            if debug.is_enabled:
+                debug.circle((255, 0, 0), collision.rect.center, 4)
+                debug.rect((255, 0, 0), collision.rect)
 
             if collision.surftype == environment.SurfaceType.Hazard:
                 self.animate('falling')
@@ -72,111 +104,147 @@ class Skater(SpriteSheet):
             else:
                 raise NotImplementedError()
         else:
-            self.state.world.remove(self.debug_overlay)
-
             # Check whether we're rolling off the ground...
             if self.surface:
-                start = pygame.math.Vector2(self.rect.midbottom)
-                end = start.copy()
-                end.y += self.gravity * dt
+                probe_start = pygame.math.Vector2(self.rect.midbottom)
+                probe_end = probe_start.copy()
+                probe_end.y += self.gravity * dt
 
-                if not self.surface.rect.clipline(start, end):
+                if not self.surface.rect.clipline(probe_start, probe_end):
                     self.depart()
+                elif self.state.env.get_ground_height(self.rect.centerx, self.surface) != self.rect.bottom:
+                    # Follow sloped ground down
+                    self.land(self.surface, dt)
+
+        # Sparks trail along a ledge for as long as it's ground
+        if self.surface and self.surface.surftype == environment.SurfaceType.Ledge:
+            self.emit('sparks', 1)
 
         prev_ledge = self.current_ledge
         self.current_ledge = self.state.env.get_ledge_at(self.rect)
+        if not self.current_ledge and not self.is_grounded and start != end:
+            self.current_ledge, _ = self.state.env.get_ledge_along(start, end)
         if self.current_ledge and self.current_ledge != prev_ledge and not self.is_grounded:
-            ticks = pygame.time.get_ticks()
-            if ticks <= self.grind_deadline:
+            ticks = self.state.timer.get_ticks()
+            if self.inputs.find((Action.Grind,), ticks - self.input_look_ahead):
                 self.land(self.current_ledge, dt)
-                self.do_grind(self.last_dir if ticks - self.last_dir_time < self.input_look_back else None)
+                self.do_grind(self.inputs.find(directions, ticks - self.input_look_back))
 
         SpriteSheet.update(self, dt)
 
     def land(self, collision, dt):
         self.surface = collision
+        if not self.is_grounded and collision.surftype == environment.SurfaceType.Pavement:
+            # Kick up dust, more the harder it lands
+            self.emit('dust', 4 + int(self.velocity.y / self.scale * 16))
+            self.state.record(telemetry.Land, value=self.velocity.y / self.scale * 1000)
         self.is_grounded = True
-        # FIXME: Assuming all ground is flat
         self.velocity.y = 0
         # HELLA simplified collision handling - I was overthinking things
-        self.rect.bottom = collision.rect.top
+        self.rect.bottom = round(self.state.env.get_ground_height(self.rect.centerx, collision))
+        self.position.y = self.rect.y
+
+    def reaches_ground(self, surface, x, bottom):
+        # Sloped ground can sit well below the top of its rect; it's only touched once the sprite gets down to it
+        if surface.surftype != environment.SurfaceType.Pavement:
+            return True
+        return bottom >= self.state.env.get_ground_height(x, surface)
+
+    def move_to(self, midbottom):
+        self.rect.midbottom = midbottom
+        self.position.update(self.rect.topleft)
+
+    def get_render_position(self, alpha):
+        # Blend between the last two physics states when the simulation runs at a fixed rate
+        position = self.last_position.lerp(self.position, alpha)
+        return round(position.x), round(position.y)
 
     def depart(self):
         self.is_grounded = False
         self.surface = None
 
     def do_flip(self, direction):
-        if direction == 'left':
+        if direction == Action.Left:
             self.animate('kickflip')
-        elif direction == 'right':
+        elif direction == Action.Right:
             self.animate('heelflip')
 
     def do_grind(self, direction):
-        if direction == 'right':
+        if direction == Action.Right:
             self.animate('nosegrind')
         else:
             self.animate('5-0')
+        self.emit('sparks', 24)
+
+    def emit(self, effect, count):
+        particles = self.state.particles
+        if particles:
+            particles.emit(effect, self.rect.midbottom, count, self.velocity)
 
     def handle_latent(self, action):
-        ticks = pygame.time.get_ticks()
-        pressed = pygame.key.get_pressed()
-        last_dir_valid = (ticks - self.last_dir_time) < self.input_look_back
-        if pressed[pygame.K_LEFT] or last_dir_valid and self.last_dir == 'left':
-            action('left')
-        elif pressed[pygame.K_RIGHT] or last_dir_valid and self.last_dir == 'right':
-            action('right')
+        ticks = self.state.timer.get_ticks()
+        actions, keys = self.state.actions, self.state.keys
+        last_dir = self.inputs.find(directions, ticks - self.input_look_back)
+        if actions.is_held(keys, Action.Left) or last_dir == Action.Left:
+            action(Action.Left)
+        elif actions.is_held(keys, Action.Right) or last_dir == Action.Right:
+            action(Action.Right)
         else:
             self.latent_action = action
             self.latent_action_deadline = ticks + self.input_look_ahead
 
     def handle(self, event):
         if event.type == pygame.KEYDOWN:
-            ticks = pygame.time.get_ticks()
-            name = pygame.key.name(event.key)
-
-            # Handle look-ahead / look-back for directional inputs
-            if name in ('up', 'down', 'left', 'right'):
-                self.last_dir = name
-                self.last_dir_time = pygame.time.get_ticks()
+            action = self.state.actions.get(event.key)
+            if action is None:
+                return
+            ticks = self.state.timer.get_ticks()
+            self.inputs.push(ticks, action)
+
+            # Handle look-ahead for directional inputs
+            if action in directions:
                 if self.latent_action and ticks <= self.latent_action_deadline:
-                    self.latent_action(name)
+                    self.latent_action(action)
                     self.latent_action = None
 
-            # Flip Tricks on X
-            if name == 'x':
+            # Flip Tricks
+            if action == Action.Flip:
                 if not self.is_grounded and self.animation not in ('ollie', 'float'):
                     # Consuming this input
                     return
 
                 if self.is_grounded:
-                    self.velocity.y = -1
+                    self.velocity.y = -self.scale
                     self.depart()
                     self.animate('ollie')
 
                 self.handle_latent(self.do_flip)
-            # Grind Tricks on C
-            elif name == 'c':
+            # Grind Tricks
+            elif action == Action.Grind:
                 if self.current_ledge:
+                    # Grinding straight away, so this press shouldn't also start a grind on the next ledge
+                    self.inputs.consume(Action.Grind)
                     self.land(self.current_ledge, 0)
                     self.handle_latent(self.do_grind)
-                else:
-                    self.grind_deadline = ticks + self.input_look_ahead
             # Grounded Actions (Push / Slow / Ollie)
             elif self.is_grounded:
-                if name == 'right':
-                    self.velocity.x += 0.1
-                elif name == 'left':
-                    self.velocity.x -= 0.1
-                elif name == 'space':
+                if action == Action.Right:
+                    self.velocity.x += 0.1 * self.scale
+                elif action == Action.Left:
+                    self.velocity.x -= 0.1 * self.scale
+                elif action == Action.Ollie:
                     # TODO: Crouch logic?
-                    self.velocity.y = -1
+                    self.velocity.y = -self.scale
                     self.depart()
                     self.animate('ollie')
 
     def animate(self, animation):
+        if animation == 'falling' and self.animation != 'falling':
+            self.emit('debris', 32)
+            self.state.record(telemetry.Bail)
         super().animate(animation)
 
-        if self.info['animations'][self.animation].get('display'):
+        if self.anim.display:
             self.state.update_combo(animation)
         elif animation in ('riding', 'falling', 'ded'):
             self.state.end_combo()
@@ -0,0 +1,146 @@
+import pygame
+
+
+class SpatialGrid(object):
+    """
+    A uniform grid over a list of surfaces (anything with a `rect`).
+    Each cell keeps the rects overlapping it, so a query only tests the handful of surfaces near it
+    instead of the whole list. Surfaces can be inserted, moved and removed as they're edited.
+    """
+    def __init__(self, surfaces, cell_size=128):
+        self.surfaces = []
+        self.cell_size = cell_size
+        # (cx, cy) -> (rects, indices into self.surfaces)
+        self.cells = {}
+        # surface -> its index, and the cells it was filed under, so it can be moved or removed later
+        self.indices = {}
+        self.placed = {}
+
+        for surface in surfaces:
+            self.insert(surface)
+
+    @classmethod
+    def from_cells(cls, surfaces, cell_size, cells):
+        # Adopt cells worked out ahead of time, e.g. stored with tiled level data: (cx, cy) -> indices
+        grid = cls((), cell_size)
+        grid.surfaces = list(surfaces)
+        grid.indices = {surface: idx for idx, surface in enumerate(grid.surfaces)}
+        for key, indices in cells.items():
+            grid.cells[key] = ([grid.surfaces[idx].rect for idx in indices], list(indices))
+            for idx in indices:
+                grid.placed.setdefault(idx, []).append(key)
+        return grid
+
+    def insert(self, surface):
+        # Later surfaces sit above earlier ones, e.g. for picking in the editor
+        idx = len(self.surfaces)
+        self.surfaces.append(surface)
+        self.indices[surface] = idx
+        self._place(idx)
+        return idx
+
+    def remove(self, surface):
+        idx = self.indices.pop(surface)
+        self._unplace(idx)
+        # Leave a gap rather than renumbering everything above it
+        self.surfaces[idx] = None
+
+    def move(self, surface):
+        # Refile a surface whose rect has changed in place
+        idx = self.indices[surface]
+        self._unplace(idx)
+        self._place(idx)
+
+    def _place(self, idx):
+        rect = self.surfaces[idx].rect
+        keys = self.placed[idx] = list(self._cells_for(rect))
+        for key in keys:
+            rects, indices = self.cells.setdefault(key, ([], []))
+            rects.append(rect)
+            indices.append(idx)
+
+    def _unplace(self, idx):
+        for key in self.placed.pop(idx, ()):
+            rects, indices = self.cells[key]
+            at = indices.index(idx)
+            del rects[at]
+            del indices[at]
+            if not indices:
+                del self.cells[key]
+
+    def _cells_for(self, rect):
+        size = self.cell_size
+        x0, y0 = rect.left // size, rect.top // size
+        # Rects are half-open, so the right / bottom edge belongs to the previous cell
+        x1, y1 = (rect.right - 1) // size, (rect.bottom - 1) // size
+        for cx in range(x0, max(x0, x1) + 1):
+            for cy in range(y0, max(y0, y1) + 1):
+                yield cx, cy
+
+    def query_point(self, pos):
+        size = self.cell_size
+        cell = self.cells.get((int(pos[0]) // size, int(pos[1]) // size))
+        if not cell:
+            return None
+
+        rects, indices = cell
+        best = None
+        for rect, idx in zip(rects, indices):
+            if rect.collidepoint(pos) and (best is None or idx < best):
+                best = idx
+
+        return None if best is None else self.surfaces[best]
+
+    def query_point_all(self, pos):
+        # Every surface under the point, bottom to top
+        size = self.cell_size
+        cell = self.cells.get((int(pos[0]) // size, int(pos[1]) // size))
+        if not cell:
+            return []
+
+        rects, indices = cell
+        return [self.surfaces[idx] for idx in sorted(idx for rect, idx in zip(rects, indices) if rect.collidepoint(pos))]
+
+    def query_rect_all(self, rect):
+        found = set()
+        for key in self._cells_for(rect):
+            cell = self.cells.get(key)
+            if cell:
+                rects, indices = cell
+                found.update(indices[hit] for hit in rect.collidelistall(rects))
+
+        return [self.surfaces[idx] for idx in sorted(found)]
+
+    def query_rect(self, rect):
+        # The best match is the uppermost surface whose top edge lies within the rect - that's the one
+        # a falling sprite could land on. Failing that, the surface it overlaps the most.
+        best, best_key = None, None
+        for surface in self.query_rect_all(rect):
+            top = surface.rect.top
+            overlap = rect.clip(surface.rect)
+            if rect.top <= top <= rect.bottom:
+                key = (0, top, -overlap.width * overlap.height)
+            else:
+                key = (1, 0, -overlap.width * overlap.height)
+            if best_key is None or key < best_key:
+                best, best_key = surface, key
+
+        return best
+
+    def query_segment(self, start, end):
+        # Returns the surface the segment enters first, along with the point where it does so
+        bounds = pygame.Rect(min(start[0], end[0]), min(start[1], end[1]),
+                             abs(end[0] - start[0]) + 1, abs(end[1] - start[1]) + 1)
+        sx, sy = start
+        best, best_point, best_dist = None, None, None
+        for surface in self.query_rect_all(bounds):
+            clipped = surface.rect.clipline(start, end)
+            if not clipped:
+                continue
+
+            point = clipped[0]
+            dist = (point[0] - sx) ** 2 + (point[1] - sy) ** 2
+            if best_dist is None or dist < best_dist:
+                best, best_point, best_dist = surface, point, dist
+
+        return best, best_point
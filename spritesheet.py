@@ -1,55 +1,125 @@
+from bisect import bisect_left
 import json
 import pygame
 
 
-class SpriteSheet(pygame.sprite.Sprite):
+class Frame(object):
+    __slots__ = ('image', 'duration', 'end')
+
+    def __init__(self, image, duration, end):
+        self.image = image
+        self.duration = duration
+        # Time from the start of the animation until this frame is done
+        self.end = end
+
+
+class Animation(object):
+    __slots__ = ('id', 'name', 'frames', 'ends', 'duration', 'looping', 'display', 'next')
+
+    def __init__(self, id, name, frames, looping, display):
+        self.id = id
+        self.name = name
+        self.frames = frames
+        self.ends = [frame.end for frame in frames]
+        self.duration = self.ends[-1]
+        self.looping = looping
+        self.display = display
+        # Resolved to the following Animation once every animation has been compiled
+        self.next = None
+
+    def get_frame_at(self, time):
+        # Frames show until their time is up, inclusive
+        return min(bisect_left(self.ends, time), len(self.ends) - 1)
+
+
+class SpriteSheet(pygame.sprite.DirtySprite):
     """
     Sprite Sheets represent an animated sprite.
     All of the animations for the character are packed into a single image.
     A JSON file describes the animations and their layout in the sheet image.
+    Frames are scaled once, as they're sliced, for resolutions other than the one they were drawn for.
     """
-    def __init__(self, info):
+    def __init__(self, info, scale=1.0):
         # Construct the base sprite and load our configuration
-        pygame.sprite.Sprite.__init__(self)
+        pygame.sprite.DirtySprite.__init__(self)
         with open(info, 'r') as file:
             self.info = json.load(file)
 
-        # Load in the sheet and construct our visible surface
+        # Load in the sheet and compile the animations, slicing every frame out of the sheet once
+        self.scale = scale
         self.sheet = pygame.image.load(self.info['filename']).convert_alpha()
-        self.image = pygame.Surface((self.info['width'], self.info['height'])).convert_alpha()
-        self.rect = self.image.get_rect()
+        self.animations = self._compile()
+        self.animation_ids = {anim.name: anim.id for anim in self.animations}
+        # Collision masks are only built for the frames which collision code actually asks about
+        self._masks = {}
 
         # Initialize animation
-        self.animation = self.info['start']
+        self.anim = self.animations[self.animation_ids[self.info['start']]]
+        self.animation = self.anim.name
         self.frame = 0
-        self.frame_time = 0
+        self.anim_time = 0
+        self.image = self.anim.frames[self.frame].image
+        self.rect = self.image.get_rect()
         self.is_dirty = True
 
+    def _compile(self):
+        animations = []
+        for id, (name, anim) in enumerate(self.info['animations'].items()):
+            frames, end = [], 0
+            for frame in anim['frames']:
+                end += frame['t']
+                frames.append(Frame(self._bake(frame), frame['t'], end))
+            animations.append(Animation(id, name, frames, anim.get('looping', False), anim.get('display', False)))
+
+        by_name = {anim.name: anim for anim in animations}
+        for anim in animations:
+            anim.next = by_name[self.info['animations'][anim.name].get('next', self.info['start'])]
+
+        return animations
+
+    def _bake(self, frame):
+        image = pygame.Surface((self.info['width'], self.info['height'])).convert_alpha()
+        image.fill((0, 0, 0, 0))
+        image.blit(self.sheet, (0, 0), (frame['x'], frame['y'], frame['w'], frame['h']))
+        if self.scale != 1:
+            image = pygame.transform.smoothscale(image, (round(image.get_width() * self.scale),
+                                                         round(image.get_height() * self.scale)))
+        return image
+
+    @property
+    def mask(self):
+        # For detailed collision testing, e.g. pygame.sprite.collide_mask
+        mask = self._masks.get(self.image)
+        if mask is None:
+            mask = self._masks[self.image] = pygame.mask.from_surface(self.image)
+        return mask
+
     def _blit(self):
         if not self.is_dirty:
             return
 
         self.is_dirty = False
-        anim = self.info['animations'][self.animation]
-        frame = anim['frames'][self.frame]
-        x, y, w, h = frame['x'], frame['y'], frame['w'], frame['h']
-        self.image.fill((0, 0, 0, 0))
-        self.image.blit(self.sheet, (0, 0), (x, y, w, h))
-        # Generate a mask for use in detailed collision testing
-        self.mask = pygame.mask.from_surface(self.image)
+        self.image = self.anim.frames[self.frame].image
+        # Leave sprites which always redraw (dirty == 2) alone
+        self.dirty = self.dirty or 1
 
     def update(self, dt, *args, **kwargs):
-        # Animate the sprite
-        self.frame_time += dt
-        anim = self.info['animations'][self.animation]
-        if self.frame_time > anim['frames'][self.frame]['t']:
+        # Animate the sprite, catching up on however much time has passed
+        self.anim_time += dt
+        anim = self.anim
+        while self.anim_time > anim.duration:
+            if anim.looping:
+                self.anim_time %= anim.duration
+            else:
+                self.anim_time -= anim.duration
+                anim = anim.next
+
+        frame = anim.get_frame_at(self.anim_time)
+        if anim is not self.anim or frame != self.frame:
+            self.anim = anim
+            self.animation = anim.name
+            self.frame = frame
             self.is_dirty = True
-            self.frame_time = 0
-            self.frame += 1
-            if self.frame >= len(anim['frames']):
-                self.frame = 0
-                if not anim.get('looping', False):
-                    self.animation = anim.get('next', self.info['start'])
 
         self._blit()
 
@@ -57,7 +127,8 @@ class SpriteSheet(pygame.sprite.Sprite):
         if self.animation == animation:
             return
 
+        self.anim = self.animations[self.animation_ids[animation]]
         self.animation = animation
         self.frame = 0
-        self.frame_time = 0
+        self.anim_time = 0
         self.is_dirty = True
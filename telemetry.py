@@ -0,0 +1,237 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor, wait
+import sqlite3
+import struct
+import time
+import zlib
+
+
+# Event kinds
+Trick = 1
+Land = 2
+Bail = 3
+Scene = 4
+Combo = 5
+
+kind_names = {Trick: 'tricks', Land: 'landings', Bail: 'bails', Scene: 'scene changes', Combo: 'combos'}
+
+# Records: game time (ms), kind, level and trick (ids of their names), and a value - points, speed, direction
+_record = struct.Struct('<IBIIi')
+
+# Each trick in a combo is worth this much, multiplied by how many tricks the combo has
+trick_points = 100
+
+
+def get_name_id(name):
+    return zlib.crc32(name.encode('utf-8')) if name else 0
+
+
+def score_combo(tricks):
+    return trick_points * len(tricks) * len(tricks)
+
+
+_schema = """
+CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, started REAL);
+CREATE TABLE IF NOT EXISTS names (id INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE IF NOT EXISTS events (run INTEGER, time INTEGER, kind INTEGER, level INTEGER, trick INTEGER,
+                                   value INTEGER);
+CREATE TABLE IF NOT EXISTS scores (run INTEGER, time INTEGER, level INTEGER, value INTEGER);
+CREATE INDEX IF NOT EXISTS scores_by_value ON scores (value);
+CREATE INDEX IF NOT EXISTS scores_by_level ON scores (level, value);
+CREATE TABLE IF NOT EXISTS level_stats (level INTEGER, kind INTEGER, count INTEGER, total INTEGER, best INTEGER,
+                                        PRIMARY KEY (level, kind)) WITHOUT ROWID;
+"""
+
+
+class ScoreStore(object):
+    """
+    The on-disk history of every run. Events are only ever appended; combos are copied into an indexed scores table,
+    and per-level totals are kept up to date as batches arrive, so neither query has to scan the events.
+    A store belongs to the thread which opened it.
+    """
+    def __init__(self, filename):
+        self.connection = sqlite3.connect(filename)
+        # Readers don't block the writer, and the writer doesn't wait on the disk for every batch
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(_schema)
+
+    def start_run(self):
+        with self.connection:
+            return self.connection.execute('INSERT INTO runs (started) VALUES (?)', (time.time(),)).lastrowid
+
+    def append(self, run, data, names):
+        records = list(_record.iter_unpack(data))
+        stats = {}
+        for _, kind, level, _, value in records:
+            count, total, best = stats.get((level, kind), (0, 0, value))
+            stats[level, kind] = count + 1, total + value, max(best, value)
+
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO names VALUES (?, ?)', names.items())
+            self.connection.executemany('INSERT INTO events VALUES (?, ?, ?, ?, ?, ?)',
+                                        ((run, *record) for record in records))
+            self.connection.executemany('INSERT INTO scores VALUES (?, ?, ?, ?)',
+                                        ((run, when, level, value) for when, kind, level, _, value in records
+                                         if kind == Combo))
+            self.connection.executemany(
+                'INSERT INTO level_stats VALUES (?, ?, ?, ?, ?) ON CONFLICT (level, kind) DO UPDATE SET '
+                'count = count + excluded.count, total = total + excluded.total, best = max(best, excluded.best)',
+                ((level, kind, *values) for (level, kind), values in stats.items()))
+
+    def get_high_scores(self, limit=10, level=None):
+        # [(points, level, run), ...], best first
+        query = 'SELECT value, names.name, run FROM scores LEFT JOIN names ON names.id = level'
+        if level is None:
+            rows = self.connection.execute(query + ' ORDER BY value DESC LIMIT ?', (limit,))
+        else:
+            rows = self.connection.execute(query + ' WHERE level = ? ORDER BY value DESC LIMIT ?',
+                                           (get_name_id(level), limit))
+        return rows.fetchall()
+
+    def get_level_stats(self, level):
+        # Kind -> (count, total, best)
+        rows = self.connection.execute('SELECT kind, count, total, best FROM level_stats WHERE level = ?',
+                                       (get_name_id(level),))
+        return {kind: (count, total, best) for kind, count, total, best in rows}
+
+    def get_levels(self):
+        rows = self.connection.execute('SELECT DISTINCT names.name FROM level_stats JOIN names ON names.id = level')
+        return sorted(name for name, in rows)
+
+    def close(self):
+        self.connection.close()
+
+
+class Telemetry(object):
+    """
+    Records run events into a fixed size ring of packed records, costing the frame a struct.pack_into.
+    Batches are handed to a writer thread once enough have built up, or every so often, or on closing.
+    Batches wait in the ring while the writer's behind by `max_batches`. If the ring fills before a batch goes,
+    the oldest records are dropped and counted - as is everything once the writer's failed.
+    """
+    def __init__(self, filename, capacity=4096, batch_size=256, flush_interval=2000, max_batches=4):
+        self.filename = filename
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = bytearray(capacity * _record.size)
+        # Counts of records ever written, and ever handed to the writer
+        self.head = 0
+        self.flushed = 0
+        self.dropped = 0
+        self.max_batches = max_batches
+        self.batches = []
+        # Whatever stopped the writer; nothing more is recorded after it
+        self.error = None
+        # Records in batches the writer couldn't write; only ever touched on the writer thread
+        self.failed = 0
+        self.last_flush = 0
+        self.ids = {}
+        self.new_names = {}
+        self.store = None
+        self.run = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='telemetry')
+
+    def _get_id(self, name):
+        name_id = self.ids.get(name)
+        if name_id is None:
+            name_id = self.ids[name] = get_name_id(name)
+            if name_id:
+                self.new_names[name_id] = name
+        return name_id
+
+    def record(self, now, kind, level, trick=None, value=0):
+        if self.error is not None:
+            self.dropped += 1
+            return
+        if self.head - self.flushed >= self.capacity:
+            self.flushed += 1
+            self.dropped += 1
+        offset = (self.head % self.capacity) * _record.size
+        _record.pack_into(self.buffer, offset, int(now) & 0xFFFFFFFF, kind, self._get_id(level), self._get_id(trick),
+                          int(value))
+        self.head += 1
+        if self.head - self.flushed >= self.batch_size:
+            self.flush(now)
+
+    def poll(self, now):
+        if self.head != self.flushed and now - self.last_flush >= self.flush_interval:
+            self.flush(now)
+
+    def flush(self, now=None):
+        if now is not None:
+            self.last_flush = now
+        if self.head == self.flushed:
+            return
+        if self.error is not None:
+            self.dropped += self.head - self.flushed
+            self.flushed = self.head
+            return
+        # While the writer's behind, leave the records in the ring; once that fills, record() drops the oldest
+        self.batches = [batch for batch in self.batches if not batch.done()]
+        if len(self.batches) >= self.max_batches:
+            return
+
+        start, end = self.flushed % self.capacity, self.head % self.capacity
+        size = _record.size
+        if start < end:
+            data = bytes(self.buffer[start * size:end * size])
+        else:
+            data = bytes(self.buffer[start * size:]) + bytes(self.buffer[:end * size])
+        self.flushed = self.head
+        names, self.new_names = self.new_names, {}
+        self.batches.append(self.executor.submit(self._write, data, names))
+
+    def _write(self, data, names):
+        # On the writer thread, which owns the store; nothing's created until there's something to write
+        if self.error is not None:
+            self.failed += len(data) // _record.size
+            return
+        try:
+            if self.store is None:
+                self.store = ScoreStore(self.filename)
+                self.run = self.store.start_run()
+            self.store.append(self.run, data, names)
+        except (sqlite3.Error, OSError) as error:
+            # Disk full, a locked or mismatched database... the game carries on without telemetry
+            print('Telemetry stopped writing to %s: %s' % (self.filename, error))
+            self.error = error
+            self.failed += len(data) // _record.size
+
+    def _close_store(self):
+        if self.store:
+            self.store.close()
+
+    def close(self):
+        # Whatever's still in the ring goes, however far behind the writer is
+        wait(self.batches)
+        self.flush()
+        self.executor.submit(self._close_store)
+        self.executor.shutdown(wait=True)
+        if self.error is not None:
+            print('Telemetry: %d records were lost after %s' % (self.dropped + self.failed, self.error))
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Show high scores and per-level stats from recorded runs')
+    parser.add_argument('--db', default='telemetry.db')
+    parser.add_argument('--level', help='Only this level')
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args(args)
+
+    store = ScoreStore(args.db)
+    print('High scores%s:' % (' on ' + args.level if args.level else ''))
+    for rank, (points, level, run) in enumerate(store.get_high_scores(args.top, args.level), 1):
+        print('  %2d. %8d  %s (run %d)' % (rank, points, level, run))
+
+    for level in [args.level] if args.level else store.get_levels():
+        print(level)
+        for kind, (count, total, best) in sorted(store.get_level_stats(level).items()):
+            print('  %-14s %8d  best %d' % (kind_names.get(kind, kind), count, best))
+    store.close()
+
+
+if __name__ == '__main__':
+    import sys
+    main(sys.argv[1:])
@@ -0,0 +1,61 @@
+import time
+import types
+import unittest
+import pygame
+import netghost
+
+
+def make_skater(x):
+    return types.SimpleNamespace(position=pygame.math.Vector2(x, 100), velocity=pygame.math.Vector2(0.5, 0),
+                                 anim=types.SimpleNamespace(id=2), frame=1, scale=1.0)
+
+
+class BadPacketTest(unittest.TestCase):
+    def setUp(self):
+        self.server = netghost.GhostServer()
+        self.server.start()
+        self.sender = netghost.GhostClient(self.server.address, send_interval=0)
+        self.receiver = netghost.GhostClient(self.server.address, send_interval=0)
+
+    def tearDown(self):
+        self.sender.close()
+        self.receiver.close()
+        self.server.close()
+
+    def wait_for(self, condition, timeout=2.0):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                return False
+            self.receiver.poll(0)
+            time.sleep(0.01)
+        return True
+
+    def test_relay_survives_bad_packets(self):
+        # The relay only forwards to players it knows of
+        self.receiver.send(0, make_skater(0), 'assets/Basic.json')
+        self.assertTrue(self.wait_for(lambda: len(self.server.clients) == 1))
+
+        # A short packet, then a snapshot header with a body too short for a snapshot
+        self.sender.socket.send(b'\x01\x00')
+        self.sender.socket.send(netghost._header.pack(netghost.Snapshot, 0, 1, 0xFFFF) + b'\xff')
+        self.assertTrue(self.wait_for(lambda: self.server.dropped == 2))
+        self.assertEqual(len(self.server.clients), 1)
+
+        self.sender.send(10, make_skater(50), 'assets/Basic.json')
+        self.assertTrue(self.wait_for(lambda: self.receiver.ghosts))
+        self.assertTrue(self.server.thread.is_alive())
+        ghost = next(iter(self.receiver.ghosts.values()))
+        (x, y), _, anim, frame, _ = ghost.sample(10)
+        self.assertEqual((x, y, anim, frame), (50, 100, 2, 1))
+
+    def test_client_ignores_bad_packets(self):
+        for data in (b'', b'\x01', b'\x09\x00\x00\x00\x00\x00',
+                     netghost._header.pack(netghost.Snapshot, 3, 1, 0xFFFF) + b'\x00'):
+            self.receiver._receive(data, 0)
+        self.assertEqual(self.receiver.dropped, 4)
+        self.assertFalse(any(ghost.snapshots for ghost in self.receiver.ghosts.values()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+from collections import OrderedDict
+import pygame
+
+
+class TextCache(object):
+    """
+    Rendered text, keyed on (font, text, color), with the least recently used evicted beyond a capacity.
+    Rendered surfaces are never modified, so they're safe to share between callers.
+    """
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+
+    def render(self, font: pygame.font.Font, text, color) -> pygame.Surface:
+        key = (font, text, tuple(color))
+        surface = self.entries.get(key)
+        if surface:
+            self.entries.move_to_end(key)
+            return surface
+
+        surface = self.entries[key] = font.render(text, True, color)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+        return surface
+
+
+text_cache = TextCache()
+
+
+class ComboText(object):
+    """
+    A line of tricks joined by ' + ', composed from cached pieces and wrapped onto further lines.
+    Adding a trick only redraws the line it lands on.
+    """
+    separator = ' + '
+    wrapped_separator = '+ '
+
+    def __init__(self, font, color, width, max_lines=3, cache=text_cache):
+        self.font = font
+        self.color = color
+        self.width = width
+        self.max_lines = max_lines
+        self.cache = cache
+        self.line_height = font.get_linesize()
+        self.surface = pygame.Surface((width, self.line_height * max_lines), pygame.SRCALPHA)
+        self.lines = [[]]
+        self.line_widths = [0]
+        self.is_ended = False
+
+    def add(self, trick):
+        if self.is_ended:
+            self.clear()
+
+        piece = self.cache.render(self.font, trick, self.color)
+        is_scrolled = False
+        if self.lines[-1]:
+            separator = self.cache.render(self.font, self.separator, self.color)
+            if self.line_widths[-1] + separator.get_width() + piece.get_width() <= self.width:
+                self._add_piece(separator)
+            else:
+                # Wrap, scrolling the oldest line away if we're out of room
+                if len(self.lines) == self.max_lines:
+                    del self.lines[0], self.line_widths[0]
+                    is_scrolled = True
+                self.lines.append([])
+                self.line_widths.append(0)
+                self._add_piece(self.cache.render(self.font, self.wrapped_separator, self.color))
+
+        self._add_piece(piece)
+        if is_scrolled:
+            self._redraw_all()
+        else:
+            self._redraw_line(len(self.lines) - 1)
+
+    def end(self):
+        # The last combo stays up until the next one starts
+        self.is_ended = True
+
+    def clear(self):
+        self.surface.fill((0, 0, 0, 0))
+        self.lines = [[]]
+        self.line_widths = [0]
+        self.is_ended = False
+
+    def get_height(self):
+        return self.line_height * len(self.lines)
+
+    def _add_piece(self, piece):
+        self.lines[-1].append(piece)
+        self.line_widths[-1] += piece.get_width()
+
+    def _redraw_line(self, idx):
+        y = idx * self.line_height
+        self.surface.fill((0, 0, 0, 0), (0, y, self.width, self.line_height))
+        x = (self.width - self.line_widths[idx]) // 2
+        for piece in self.lines[idx]:
+            self.surface.blit(piece, (x, y))
+            x += piece.get_width()
+
+    def _redraw_all(self):
+        self.surface.fill((0, 0, 0, 0))
+        for idx in range(len(self.lines)):
+            self._redraw_line(idx)
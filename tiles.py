@@ -0,0 +1,300 @@
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+import json
+import mmap
+import os
+import struct
+import sys
+import pygame
+import environment
+import render
+from environment import Environment, Surface, SurfaceType
+from heightfield import Heightfield, scale_ramps
+from loadcache import LoadCache
+from profiler import profiler
+from spatial import SpatialGrid
+
+
+# Layout: header, info JSON, surface type codes, world rects (x, y, w, h), the surfaces overlapping each tile
+# as offsets into a list of ids, then every tile's art - fixed size, so any tile can be found without an index.
+# Geo may hang off the edges of the art, so its tiles cover their own, possibly larger, range.
+_magic = b'MSGT'
+_version = 1
+_header = struct.Struct('<4sHHHHIIIIhhHH')
+_art_format = 'RGB'
+
+
+def get_tile_filename(info, level, size=None):
+    # Tiles are cut from the art at the size it's played at, so each resolution compiles its own
+    return os.path.splitext(level.get('tiles') or info)[0] + render.get_size_suffix(size) + '.tiles'
+
+
+def is_stale(info, tile_filename):
+    # Tiled levels are stitched together from sections, each a regular level
+    if not os.path.exists(tile_filename):
+        return True
+
+    tile_time = os.path.getmtime(tile_filename)
+    with open(info, 'r') as file:
+        sources = [info] + json.load(file).get('sections', [])
+    for source in sources:
+        if os.path.getmtime(source) > tile_time:
+            return True
+        if source != info:
+            with open(source, 'r') as file:
+                section = json.load(file)
+            if any(os.path.getmtime(section[key]) > tile_time for key in ('art', 'geo') if section.get(key)):
+                return True
+
+    return False
+
+
+def save(filename, info, geo, art: pygame.Surface, tile_size):
+    width, height = art.get_size()
+    cols, rows = -(-width // tile_size), -(-height // tile_size)
+
+    types = array('B', (int(surftype) for surftype, _ in geo))
+    rects = array('i')
+    for _, rect in geo:
+        rects.extend(rect)
+
+    # Which surfaces each tile holds, so a query only has to look at the tiles it touches
+    grid = SpatialGrid([Surface(SurfaceType(surftype), *rect) for surftype, rect in geo], tile_size)
+    geo_col0 = min([0] + [col for col, _ in grid.cells])
+    geo_row0 = min([0] + [row for _, row in grid.cells])
+    geo_cols = max([cols - 1] + [col for col, _ in grid.cells]) - geo_col0 + 1
+    geo_rows = max([rows - 1] + [row for _, row in grid.cells]) - geo_row0 + 1
+    offsets, ids = array('I', [0]), array('I')
+    for row in range(geo_row0, geo_row0 + geo_rows):
+        for col in range(geo_col0, geo_col0 + geo_cols):
+            ids.extend(grid.cells.get((col, row), ((), ()))[1])
+            offsets.append(len(ids))
+
+    if sys.byteorder != 'little':
+        for values in (rects, offsets, ids):
+            values.byteswap()
+
+    info_bytes = json.dumps(info).encode('utf-8')
+    tile = pygame.Surface((tile_size, tile_size))
+
+    # Write beside the target and swap in, so a reader never sees half a file
+    temp = filename + '.tmp'
+    with open(temp, 'wb') as file:
+        file.write(_header.pack(_magic, _version, tile_size, cols, rows, width, height, len(types), len(info_bytes),
+                                geo_col0, geo_row0, geo_cols, geo_rows))
+        file.write(info_bytes)
+        file.write(types.tobytes())
+        file.write(rects.tobytes())
+        file.write(offsets.tobytes())
+        file.write(ids.tobytes())
+        for row in range(rows):
+            for col in range(cols):
+                # Tiles along the right and bottom edges are padded out to full size
+                tile.fill((0, 0, 0))
+                tile.blit(art, (0, 0), (col * tile_size, row * tile_size, tile_size, tile_size))
+                file.write(pygame.image.tobytes(tile, _art_format))
+    os.replace(temp, filename)
+
+
+def compile_level(info, size=render.design_size, tile_size=256):
+    """
+    Stitches the sections a tiled level lists into one long level, left to right,
+    each scaled to `size` as a single screen level would be - geo included.
+    """
+    with open(info, 'r') as file:
+        level = json.load(file)
+
+    arts, geo = [], []
+    for idx, section in enumerate(level['sections']):
+        with open(section, 'r') as file:
+            section = json.load(file)
+        arts.append(pygame.transform.scale(pygame.image.load(section['art']), size))
+        geo.extend((surface.surftype.value, surface.rect.move(idx * size[0], 0))
+                   for surface in environment.scale_geo(environment.load_legacy_geo(section['geo']),
+                                                        render.get_scale(size)))
+
+    art = pygame.Surface((size[0] * len(arts), size[1]))
+    for idx, section_art in enumerate(arts):
+        art.blit(section_art, (idx * size[0], 0))
+
+    save(get_tile_filename(info, level, size), level, [(surftype, tuple(rect)) for surftype, rect in geo],
+         art, tile_size)
+
+
+class TiledEnvironment(Environment):
+    """
+    A level wider (or taller) than the screen, streamed from a memory-mapped tile file.
+    Geo is small and stays resident; art tiles are decoded only as the camera nears them,
+    ahead of time in the direction of travel, and the least recently drawn are evicted past a memory budget.
+    Collision queries work in world coordinates, just as for a single screen Environment.
+    """
+    def __init__(self, info, size, budget=16 * 1024 * 1024, lookahead=1):
+        # Construct the base sprite and load our configuration
+        pygame.sprite.DirtySprite.__init__(self)
+        self.filename = info
+        self.scale = render.get_scale(size)
+        with open(info, 'r') as file:
+            self.info = json.load(file)
+
+        if self.info.get('sections'):
+            filename = get_tile_filename(info, self.info, size)
+            if is_stale(info, filename):
+                compile_level(info, size)
+        else:
+            # Compiled elsewhere, at whatever size it was compiled at
+            filename = self.info['tiles']
+        self._map(filename)
+
+        # What's drawn is the screen's worth of tiles under the camera
+        self.image = pygame.Surface(size).convert()
+        self.rect = self.image.get_rect()
+        self.camera = None
+        self.budget = budget
+        self.lookahead = lookahead
+        self.visible = ()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='tile-prefetch')
+        # Least recently drawn first; only ever touched from the main thread
+        self.tiles = LoadCache(self._decode, self._get_size, budget, self.executor)
+        self.follow(pygame.Rect(0, 0, 0, 0), (0, 0))
+
+    def _map(self, filename):
+        self.file = open(filename, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        data = memoryview(self.map)
+
+        magic, version, tile_size, cols, rows, width, height, count, info_len, \
+            geo_col0, geo_row0, geo_cols, geo_rows = _header.unpack_from(data)
+        if magic != _magic or version != _version:
+            raise ValueError('%s is not a version %d tile file' % (filename, _version))
+
+        self.tile_size, self.cols, self.rows = tile_size, cols, rows
+        self.bounds = pygame.Rect(0, 0, width, height)
+
+        offset = _header.size + info_len
+        types = array('B', data[offset:offset + count])
+        offset += count
+        rects = array('i', data[offset:offset + 16 * count].tobytes())
+        offset += 16 * count
+        geo_tiles = geo_cols * geo_rows
+        offsets = array('I', data[offset:offset + 4 * (geo_tiles + 1)].tobytes())
+        offset += 4 * (geo_tiles + 1)
+        ids = array('I', data[offset:offset + 4 * offsets[-1]].tobytes())
+        offset += 4 * offsets[-1]
+        if sys.byteorder != 'little':
+            for values in (rects, offsets, ids):
+                values.byteswap()
+
+        self.art_offset = offset
+        self.tile_bytes = tile_size * tile_size * len(_art_format)
+        if len(self.map) < offset + cols * rows * self.tile_bytes:
+            raise ValueError('%s is truncated' % filename)
+        data.release()
+
+        self.geo = [Surface(SurfaceType(surftype), *rects[4 * idx:4 * idx + 4]) for idx, surftype in enumerate(types)]
+        self.collision = [geo for geo in self.geo if geo.surftype != SurfaceType.Ledge]
+        self.ledges = [geo for geo in self.geo if geo.surftype == SurfaceType.Ledge]
+
+        # The tile file already says which surfaces each tile holds - split that between collision and ledges
+        collision_ids = {id(geo): idx for idx, geo in enumerate(self.collision)}
+        ledge_ids = {id(geo): idx for idx, geo in enumerate(self.ledges)}
+        collision_cells, ledge_cells = {}, {}
+        for row in range(geo_row0, geo_row0 + geo_rows):
+            for col in range(geo_col0, geo_col0 + geo_cols):
+                tile = (row - geo_row0) * geo_cols + col - geo_col0
+                for idx in ids[offsets[tile]:offsets[tile + 1]]:
+                    geo = self.geo[idx]
+                    if id(geo) in collision_ids:
+                        collision_cells.setdefault((col, row), []).append(collision_ids[id(geo)])
+                    else:
+                        ledge_cells.setdefault((col, row), []).append(ledge_ids[id(geo)])
+
+        self.collision_index = SpatialGrid.from_cells(self.collision, tile_size, collision_cells)
+        self.ledge_index = SpatialGrid.from_cells(self.ledges, tile_size, ledge_cells)
+        # Sections have no geo images to shape the ground, only ramps
+        self.heightfield = Heightfield.build(self.bounds.size, self.collision,
+                                             scale_ramps(self.info.get('ramps', ()), self.scale))
+
+    def _decode(self, tile):
+        # Slicing the map only reads this tile's bytes in
+        col, row = tile
+        offset = self.art_offset + (row * self.cols + col) * self.tile_bytes
+        data = self.map[offset:offset + self.tile_bytes]
+        return pygame.image.frombuffer(data, (self.tile_size, self.tile_size), _art_format).convert()
+
+    def _get_tiles_in(self, rect):
+        size = self.tile_size
+        col0, row0 = max(rect.left // size, 0), max(rect.top // size, 0)
+        col1, row1 = min((rect.right - 1) // size, self.cols - 1), min((rect.bottom - 1) // size, self.rows - 1)
+        return [(col, row) for row in range(row0, row1 + 1) for col in range(col0, col1 + 1)]
+
+    def get_tile(self, tile) -> pygame.Surface:
+        return self.tiles.get(tile)
+
+    @staticmethod
+    def _get_size(image):
+        return image.get_bytesize() * image.get_width() * image.get_height()
+
+    def follow(self, rect, velocity):
+        # Keep the rect centred on screen, as far as the edges of the level allow
+        view = self.rect.copy()
+        view.center = rect.center
+        view.clamp_ip(self.bounds)
+        camera = view.topleft
+
+        # Decode the tiles we're heading toward while these ones are on screen
+        with profiler.scope('TiledEnvironment.prefetch'):
+            ahead = view.copy()
+            dx, dy = velocity
+            reach = self.lookahead * self.tile_size
+            if dx:
+                ahead.width += reach
+                ahead.x -= reach if dx < 0 else 0
+            if dy:
+                ahead.height += reach
+                ahead.y -= reach if dy < 0 else 0
+            self.tiles.prefetch(self._get_tiles_in(ahead))
+
+        if camera == self.camera:
+            return
+
+        with profiler.scope('TiledEnvironment.compose'):
+            self.camera = camera
+            self.visible = self._get_tiles_in(view)
+            # Whatever's on screen stays resident, however far over budget that goes
+            self.tiles.pinned = set(self.visible)
+            size = self.tile_size
+            for col, row in self.visible:
+                self.image.blit(self.get_tile((col, row)), (col * size - view.x, row * size - view.y))
+            self.dirty = 1
+
+    def get_memory_size(self):
+        # Tiles come and go, so count the budget they're allowed rather than what's resident right now
+        return self._get_size(self.image) + self.budget
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.tiles.clear()
+        self.map.close()
+        self.file.close()
+
+
+def main(args):
+    # Usage: python tiles.py [-s WIDTHxHEIGHT] [-t TILE_SIZE] assets/Long.json ...
+    size, tile_size = render.design_size, 256
+    while len(args) > 1 and args[0] in ('-s', '-t'):
+        if args[0] == '-s':
+            size = render.parse_size(args[1])
+        else:
+            tile_size = int(args[1])
+        args = args[2:]
+
+    pygame.init()
+    for info in args:
+        with open(info, 'r') as file:
+            filename = get_tile_filename(info, json.load(file), size)
+        print('Compiling %s -> %s...' % (info, filename))
+        compile_level(info, size, tile_size)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])